@@ -0,0 +1,61 @@
+"""
+Load-tests the notification outbox dispatcher against api.fake_fcm.FakeFCM,
+without sending anything to Firebase.
+
+from services/
+python3 -m DebugTools.outbox_load_test --events 20000 --latency 0.05
+"""
+
+import argparse
+import os
+import time
+
+import db.models
+import sqlalchemy
+from dotenv import load_dotenv
+
+from api import outbox
+from api.fake_fcm import FakeFCM
+
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    CONNECTION_STRING = os.getenv("DB_CONNECTION_STRING")
+    engine = sqlalchemy.create_engine(f"postgresql+psycopg2://{CONNECTION_STRING}")
+    topic_prefix = "load-test-topic-"
+
+    with engine.connect() as conn:
+        context = {"db-conn": conn}
+        st = time.time()
+        for i in range(args.events):
+            topic = f"{topic_prefix}{i % args.topics}"
+            outbox.enqueue(context, "subscribe", topic, token=f"load-test-{i}")
+        conn.commit()
+        print(f"enqueued {args.events} events in {time.time() - st:.2f}s")
+
+    fcm = FakeFCM(latency=args.latency, failure_rate=args.failure_rate)
+    st = time.time()
+    counts = outbox.dispatch_all(engine, fcm)
+    elapsed = time.time() - st
+    print(f"dispatched {counts} in {elapsed:.2f}s, {fcm.calls} FCM calls")
+    print(f"{(counts['sent'] + counts['failed']) / elapsed:.0f} events/s")
+
+    with engine.connect() as conn:
+        outbox_table = db.models.notification_outbox
+        stmt = sqlalchemy.delete(outbox_table).where(
+            outbox_table.c.topic.startswith(topic_prefix)
+        )
+        conn.execute(stmt)
+        conn.commit()
+
+
+if __name__ == "__main__":
+    main()
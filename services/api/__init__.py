@@ -13,8 +13,10 @@ from fastapi.staticfiles import StaticFiles
 from requests import Response
 from sqlalchemy.orm import sessionmaker
 
-from api.auth import v1_auth_middleware
+from api import cache, outbox
+from api.auth import get_context_value, v1_auth_middleware
 from api.exceptions import UnauthorizedError
+from api.loaders import Loaders
 from api.query import mutation, query
 from api.time import time
 from api.version import VERSION
@@ -106,21 +108,38 @@ class DbTransactionExtension(Extension):
     """Adds a sqlalchemy connection to the context, db-conn, which begins
     a transaction at the start of a request and commits it at the end.
 
+    Also adds the request's loaders, which batch the by-id lookups made
+    while resolving the request (see api/loaders.py).
+
+    Notifications the request added to the outbox are dispatched once it
+    commits, before the response is returned (see api/outbox.py).
+
     """
 
     def request_started(self, context):
+        # drops cached rows other API instances and workers changed, see
+        # api/cache.py.
+        cache.sync(engine)
         context["db-conn"] = engine.connect()
         Session = sessionmaker()
         Session.configure(bind=engine)
         context["session"] = Session()
+        context["loaders"] = Loaders(context)
 
     def request_finished(self, context):
         context["db-conn"].commit()
         context["session"].commit()
+        if context.pop("outbox-pending", False):
+            try:
+                outbox.dispatch(context)
+            except Exception:
+                # left pending for the round worker.
+                logger.exception("outbox dispatch failed")
         context["db-conn"].close()
         context["session"].close()
         del context["db-conn"]
         del context["session"]
+        del context["loaders"]
 
 
 schema = make_executable_schema(type_defs, [query, mutation, upload_scalar])
@@ -137,6 +156,7 @@ graphql_app = GraphQL(
             v1_auth_middleware,
         ],
     ),
+    context_value=get_context_value,
     debug=True,
 )
 
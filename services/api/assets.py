@@ -302,17 +302,19 @@ class AudioBucket(S3Bucket):
             logger.info(audio_info)
 
         allow_waveform = False
+        wave_values = transcripts_vtt = None
         if allow_waveform and waveform and not processing_status_dict.get("waveform"):
             logger.info(">>> FLAG waveform = True")
             wave_values = self._ffmpeg_generate_wave(fobj.name, verbose=verbose)
-            audio_info["wave_values"] = wave_values
 
         if transcipt and not processing_status_dict.get("transcript"):
             logger.info(">>> FLAG transcipt = True")
             transcripts_vtt = self._export_transcripts_vtt(fobj.name)
-            audio_info["transcripts_vtt"] = transcripts_vtt
             logger.info("set transcripts_vtt")
 
+        # stored apart from info, see db.models.audio_transcripts.
+        Audios.update_transcripts(context, audio_id, transcripts_vtt, wave_values)
+
         values = {
             "info": json.dumps(audio_info),
             "duration": float(audio_info["length"]),
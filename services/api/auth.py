@@ -4,42 +4,91 @@
 # https://github.com/ebellocchia/bip_utils/blob/master/readme/bip32.md
 # https://github.com/ethereum/js-ethereum-cryptography?tab=readme-ov-file#bip32-hd-keygen
 
+import base64
 import logging
 import os
 from hashlib import blake2b
 
 from substrateinterface import Keypair
 
+from api.cache import TTLCache
 from api.exceptions import UnauthorizedError
+from api.time import time
 
 logger = logging.getLogger("api.auth")
 
 
+# Keypairs are parsed once per public key.
+_keypairs = TTLCache(maxsize=10000, ttl=60 * 60)
+
+# (pkh, nonce, sent_at) of recently authenticated requests. Requests sent
+# more than AUTH_NONCE_WINDOW seconds from now are rejected, so a signed
+# request can't be replayed once its nonce has left this cache.
+AUTH_NONCE_WINDOW = int(os.environ.get("AUTH_NONCE_WINDOW", 10 * 60))
+_seen_nonces = TTLCache(maxsize=100000, ttl=AUTH_NONCE_WINDOW)
+
+
+def decode_key_bytes(value):
+    """Decodes a x-pubkey or x-sig header.
+
+    Accepts a list of comma separated integers (what the app sends), a
+    0x-prefixed hex string or a base64 string. Raises ValueError if value
+    is none of these.
+
+    """
+    if "," in value:
+        return bytes(map(int, value.split(",")))
+    if value.startswith("0x"):
+        return bytes.fromhex(value[2:])
+    return base64.b64decode(value, validate=True)
+
+
+def get_keypair(public_key_bytes):
+    keypair = _keypairs.get(public_key_bytes)
+    if keypair is None:
+        keypair = Keypair(public_key=public_key_bytes, ss58_format=90)
+        _keypairs.set(public_key_bytes, keypair)
+    return keypair
+
+
 def check_v1_auth(pkh, sent_at, nonce, pubkey, sig, body):
     """Checks the authentication of the given parameters using our v1
     signingscheme.
 
-    sent_at is a string (consisting of all numbers)
+    sent_at is a string (consisting of all numbers), the milliseconds since
+    the epoch at which the request was signed
 
-    nonce, pkh, pubkey, and sig are hex strings
+    nonce and pkh are hex strings
+
+    pubkey and sig are encoded as accepted by decode_key_bytes
 
     body is string
 
-    Returns True if all is ok, False if there's some failure.
+    Returns True if all is ok, False if there's some failure, including
+    a request sent more than AUTH_NONCE_WINDOW from now or a nonce that
+    was already used within it.
 
     """
 
-    public_key_string = pubkey
-
-    # Convert string to a list of integers
-    public_key_integers = list(map(int, public_key_string.split(",")))
+    try:
+        sent_at_seconds = int(sent_at) / 1000
+    except ValueError:
+        logger.debug("invalid sent_at %s", sent_at)
+        return False
+    if abs(time.utcnow().timestamp() - sent_at_seconds) > AUTH_NONCE_WINDOW:
+        logger.info("sent_at %s outside of the nonce window", sent_at)
+        return False
 
-    public_key_bytes = bytes(public_key_integers)
+    if (pkh, nonce, sent_at) in _seen_nonces:
+        logger.info("replayed nonce %s", nonce)
+        return False
 
     try:
-        keypair = Keypair(public_key=public_key_bytes, ss58_format=90)
+        public_key_bytes = decode_key_bytes(pubkey)
+        keypair = get_keypair(public_key_bytes)
     except ValueError:
         logger.debug("invalid public key")
+        return False
 
     message = ".".join([sent_at, nonce, body]).encode("utf-8")
 
@@ -51,32 +100,42 @@ def check_v1_auth(pkh, sent_at, nonce, pubkey, sig, body):
         logger.debug("pkh / pubkey mismatch")
         return False
 
-    signature_list = list(map(int, sig.split(",")))
-    signature_bytes = bytes(signature_list)
     # verify the signature matches the hash of the message
     try:
+        signature_bytes = decode_key_bytes(sig)
         is_valid = keypair.verify(message, signature_bytes)
     except ValueError:
         logger.debug("message verification failed")
         return False
 
+    # only authenticated requests are remembered, and concurrent duplicates
+    # of one are let through once.
+    if is_valid and not _seen_nonces.add((pkh, nonce, sent_at)):
+        logger.info("replayed nonce %s", nonce)
+        return False
+
     logger.info("is_valid: %s", is_valid)
     return is_valid
 
 
-async def v1_auth_middleware(resolver, obj, info, **kwargs):
-    request = info.context["request"]
+async def v1_auth_failure(request):
+    """Verifies the v1 signature of a graphql request.
+
+    Returns None if the request is authenticated, else the reason it
+    failed.
+
+    """
     headers = request.headers
 
     # Ensure auth bypass is only allowed in development environment
     if headers.get("Odessa-Disable-Auth") == "true" and os.getenv("ENV") == "dev":
         logger.debug("Auth disabled in development environment")
-        return resolver(obj, info, **kwargs)
+        return None
 
     # Check for required 'persona-pkh' header
     pkh = headers.get("persona-pkh")
     if not pkh:
-        raise UnauthorizedError("missing persona pkh")
+        return "missing persona pkh"
 
     # Handle authentication with cryptographic headers
     try:
@@ -88,10 +147,28 @@ async def v1_auth_middleware(resolver, obj, info, **kwargs):
     except KeyError:
         logger.debug("missing required auth header, request headers follow")
         logger.debug(headers)
-        raise UnauthorizedError("missing required auth header")
+        return "missing required auth header"
 
     if not check_v1_auth(pkh, sent_at, nonce, pubkey, sig, body):
         logger.info("failed authentication")
-        raise UnauthorizedError("failed authentication")
+        return "failed authentication"
+
+    return None
+
+
+async def get_context_value(request, data):
+    """Builds the graphql context of a request.
+
+    The signature is verified here, once per request, and the outcome kept
+    in context["v1-auth-failure"] for v1_auth_middleware.
+
+    """
+    return {"request": request, "v1-auth-failure": await v1_auth_failure(request)}
+
+
+def v1_auth_middleware(resolver, obj, info, **kwargs):
+    failure = info.context["v1-auth-failure"]
+    if failure is not None:
+        raise UnauthorizedError(failure)
 
     return resolver(obj, info, **kwargs)
@@ -205,6 +205,10 @@ class BridgedCommunity(Community):
         logger.info(f"MEMBERS len {len(members)}")
         return members
 
+    @property
+    def member_community_ids(self):
+        return self.bridge_ids
+
     @property
     def flags(self):
         """Returns intersection of flags"""
@@ -227,6 +231,10 @@ class BridgedCommunity(Community):
         """Cannot register personas to bridged community"""
         raise Exception("BridgedCommunity cannot register personas.")
 
+    def handle_registrations(self, *args, **kargs):
+        """Cannot register personas to bridged community"""
+        raise Exception("BridgedCommunity cannot register personas.")
+
     @property
     def policies(self):
         c0, c1 = self.bridges
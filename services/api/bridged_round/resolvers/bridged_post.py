@@ -32,14 +32,16 @@ class BridgedPost(Post):
     @property
     def author(self):
         author = Personas.get(self._context, persona_id=self.author_id)
-        author._fields["_known_by_requester"] = True
+        # copy, the Persona returned by Personas.get is shared by the request.
+        fields = dict(author._fields)
+        fields["_known_by_requester"] = True
         # TODO(bcsaldias): this could be optimized to be one query.
         requester_pkh = self._context.get("auth0", [])
         if requester_pkh:
             requester = Personas.get(self._context, pkh=requester_pkh[0])
             known_by_requester = self.community.know_each_other(requester, author)
-            author._fields["_known_by_requester"] = known_by_requester
-        author = Persona(self._context, author._fields)
+            fields["_known_by_requester"] = known_by_requester
+        author = Persona(self._context, fields)
         return author
 
     # cached_property
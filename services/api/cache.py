@@ -0,0 +1,260 @@
+"""
+Small in-process caches shared by the API workers.
+
+TTLCache is a bounded, thread-safe mapping whose entries expire after a
+fixed number of seconds. When full, the oldest entry is evicted first.
+
+Caches of database rows are registered by table name. Writers call
+invalidate(conn, table, key), which drops the entry locally and sends a
+Postgres NOTIFY on the writer's transaction, which other processes apply
+once it commits. Long-lived processes, such as the round worker, run
+listen(engine), a thread applying them as they arrive. The API runs on
+Lambda, which freezes the process between invocations, so it calls
+sync(engine) when a request starts instead. Until the transaction
+commits, the writer's own reads of the key may see uncommitted rows, so
+they must not be cached by the process, see invalidated(conn, table, key).
+"""
+
+import json
+import logging
+import select
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+logger = logging.getLogger("api.cache")
+
+INVALIDATION_CHANNEL = "odessa_cache_invalidation"
+
+# conn.info key of the (transaction, {(table, key)}) invalidated by conn.
+_INVALIDATED = "cache-invalidated"
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl, timer=monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._timer():
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def add(self, key, value=True):
+        """Sets key only if it is not already cached.
+        Returns True if it was added, False if it was already there.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._timer():
+                return False
+            self._set(key, value)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self._timer():
+                return default
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (self._timer() + self.ttl, value)
+        self._expire()
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _expire(self):
+        # entries are kept in insertion order, so they expire in order too.
+        now = self._timer()
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+
+
+_missing = object()
+
+
+_registered = {}
+
+
+def register(table, cache):
+    """Registers cache as holding rows of table, keyed as in invalidate."""
+    _registered.setdefault(table, []).append(cache)
+    return cache
+
+
+def invalidate(conn, table, key):
+    """Drops key from the caches of table, here and, once conn's
+    transaction commits, in every listening process."""
+    _drop(table, key)
+    _invalidated_keys(conn).add((table, key))
+    payload = json.dumps({"table": table, "key": key})
+    conn.execute(
+        sqlalchemy.select(sqlalchemy.func.pg_notify(INVALIDATION_CHANNEL, payload))
+    )
+
+
+def invalidate_many(conn, table, keys):
+    """Same as invalidate for each of keys, with one statement."""
+    payloads = []
+    invalidated = _invalidated_keys(conn)
+    for key in keys:
+        _drop(table, key)
+        invalidated.add((table, key))
+        payloads.append(json.dumps({"table": table, "key": key}))
+    if not payloads:
+        return
+    payload = sqlalchemy.func.unnest(
+        sqlalchemy.bindparam(
+            "payloads", payloads, type_=postgresql.ARRAY(sqlalchemy.String)
+        )
+    ).column_valued("payload")
+    conn.execute(
+        sqlalchemy.select(sqlalchemy.func.pg_notify(INVALIDATION_CHANNEL, payload))
+    )
+
+
+def invalidated(conn, table, key):
+    """Whether key of table was invalidated in conn's current transaction.
+    Rows of that key read by conn might not be committed, or might be
+    outdated by the commit, and aren't to be cached by the process."""
+    transaction, keys = conn.info.get(_INVALIDATED, (None, ()))
+    return (table, key) in keys and transaction is conn.get_transaction()
+
+
+def _invalidated_keys(conn):
+    transaction = conn.get_transaction()
+    invalidated = conn.info.get(_INVALIDATED)
+    if invalidated is None or invalidated[0] is not transaction:
+        invalidated = conn.info[_INVALIDATED] = (transaction, set())
+    return invalidated[1]
+
+
+def _drop(table, key):
+    for cache in _registered.get(table, []):
+        cache.pop(key)
+
+
+def clear_all():
+    """Empties every registered cache."""
+    for caches in _registered.values():
+        for cache in caches:
+            cache.clear()
+
+
+def _listening_connection(engine):
+    connection = engine.raw_connection()
+    dbapi_connection = connection.driver_connection
+    # not returned to the pool, it only ever listens.
+    connection.detach()
+    dbapi_connection.autocommit = True
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+    return dbapi_connection
+
+
+def _apply_notifies(dbapi_connection):
+    while dbapi_connection.notifies:
+        notify = dbapi_connection.notifies.pop(0)
+        message = json.loads(notify.payload)
+        _drop(message["table"], message["key"])
+
+
+def _close(dbapi_connection):
+    try:
+        dbapi_connection.close()
+    except Exception:
+        pass
+
+
+def listen(engine, poll_timeout=5, retry_delay=5, stop=None):
+    """Starts a daemon thread that applies the invalidations sent by other
+    processes, until the threading.Event stop, if given, is set. Caches are
+    cleared whenever the thread (re)connects, since notifications sent
+    while it wasn't listening are lost.
+    """
+    stop = stop or threading.Event()
+
+    def run():
+        while not stop.is_set():
+            dbapi_connection = None
+            try:
+                dbapi_connection = _listening_connection(engine)
+                clear_all()
+                while not stop.is_set():
+                    ready, _, _ = select.select(
+                        [dbapi_connection], [], [], poll_timeout
+                    )
+                    if not ready:
+                        continue
+                    dbapi_connection.poll()
+                    _apply_notifies(dbapi_connection)
+                _close(dbapi_connection)
+            except Exception:
+                logger.exception("cache invalidation listener failed, reconnecting")
+                if dbapi_connection is not None:
+                    _close(dbapi_connection)
+                clear_all()
+                stop.wait(retry_delay)
+
+    thread = threading.Thread(target=run, name="cache-invalidation", daemon=True)
+    thread.start()
+    return thread
+
+
+_sync_connection = None
+_sync_lock = threading.Lock()
+
+
+def sync(engine):
+    """
+    Applies the invalidations committed by other processes since the last
+    call, for processes that can't keep listen's thread running. It costs
+    one round trip on a connection kept listening: Postgres sends the
+    notifications received by a session before answering its next query.
+    Caches are cleared whenever that connection is (re)opened, since
+    notifications sent while it wasn't listening are lost.
+    """
+    global _sync_connection
+    with _sync_lock:
+        try:
+            if _sync_connection is None:
+                _sync_connection = _listening_connection(engine)
+                clear_all()
+            with _sync_connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            _apply_notifies(_sync_connection)
+        except Exception:
+            logger.exception("cache invalidation sync failed")
+            if _sync_connection is not None:
+                _close(_sync_connection)
+            _sync_connection = None
+            clear_all()
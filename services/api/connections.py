@@ -0,0 +1,65 @@
+"""
+Relay-style connections paged by id, for the lists that can grow large:
+Prompt.replies, Community.members_connection, Persona.posts_connection, ...
+
+A page holds the first rows of a query whose id is greater than the after
+cursor, the id of the last row of the previous page. It is fetched with
+WHERE id > after ORDER BY id LIMIT first + 1, the extra row telling whether
+there is a next page, so a page costs the same at any depth and doesn't
+shift when earlier rows are removed. totalCount is only counted if selected.
+"""
+
+from functools import cached_property
+
+import sqlalchemy
+
+from api import planner
+
+DEFAULT_FIRST = 20
+
+
+class Connection:
+    def __init__(self, context, stmt, key, build, first=DEFAULT_FIRST, after=None):
+        """
+        stmt selects the rows, unordered, key is their id column and
+        build(row) returns the node of a row. With first=None, every row
+        after the cursor is returned.
+        """
+        self._context = context
+        self._stmt = stmt
+
+        page = stmt.order_by(key)
+        if after is not None:
+            page = page.where(key > int(after))
+        if first is not None:
+            page = page.limit(first + 1)
+        rows = context["db-conn"].execute(page).all()
+
+        self.edges = [
+            {"cursor": str(row._mapping[key]), "node": build(row._asdict())}
+            for row in rows[:first]
+        ]
+        self.pageInfo = {
+            "endCursor": self.edges[-1]["cursor"] if self.edges else None,
+            "hasNextPage": first is not None and len(rows) > first,
+        }
+
+    @property
+    def nodes(self):
+        return [edge["node"] for edge in self.edges]
+
+    @cached_property
+    def totalCount(self):
+        stmt = sqlalchemy.select(sqlalchemy.func.count()).select_from(
+            self._stmt.subquery()
+        )
+        return self._context["db-conn"].execute(stmt).scalar()
+
+    def plan(self, info, type_name):
+        """Loads the relationships of the nodes selected by the query, see
+        api.planner. Returns the connection."""
+        if info is not None:
+            tree = planner.selections(info, "edges", "node")
+            ids = [node.id for node in self.nodes]
+            planner.prime(self._context, type_name, ids, tree)
+        return self
@@ -5,12 +5,19 @@ import db.models
 from db.models import mod_disputes, mod_reviews
 from api.resolvers import Communities, Post, Persona, Personas, create_persona
 from api.content_mod import moderation_required
+from api.loaders import get_loaders
+from api.resolvers.prompts import refresh_reply_counts
 from api.time import time
 import json
 
 logger = logging.getLogger("api.mod_disputes")
 
 
+def replied_post_of(post_id):
+    posts = db.models.posts
+    return sqlalchemy.select(posts.c.in_reply_to).where(posts.c.id == post_id)
+
+
 class Disputes:
     def __init__(
         self,
@@ -144,6 +151,7 @@ class Disputes:
         stmt = sqlalchemy.insert(mod_disputes).values(values)
         result = conn.execute(stmt)
         new_dispute_id = result.inserted_primary_key[0]
+        refresh_reply_counts(context, replied_post_of(post_id))
 
         dispute = Disputes.get(context, new_dispute_id)
         dispute.post.update_mod_cid_flag(metadata["cid"], "hide")
@@ -245,6 +253,9 @@ class Dispute:
         for k, v in fields.items():
             setattr(self, k, v)
         self._initializing = False
+        loaders = get_loaders(context)
+        loaders.posts.queue(fields.get("post_id"))
+        loaders.personas.queue(fields.get("disputer_id"))
 
     def __str__(self):
         str_rep = str(self._fields)
@@ -266,28 +277,23 @@ class Dispute:
                 .values(status=value)
             )
             conn.execute(stmt)
+            refresh_reply_counts(self._context, replied_post_of(self.post_id))
         self._fields["status"] = value
 
     @property
     def post(self):
-        posts = db.models.posts
-        stmt = sqlalchemy.select(posts).where(posts.c.id == self.post_id)
-        conn = self._context["db-conn"]
-        result = conn.execute(stmt).fetchone()
-        post = Post(self._context, result._asdict())
+        result = get_loaders(self._context).posts.load(self.post_id)
+        post = Post(self._context, result)
         if post.community.is_bridge:
             from api.bridged_round.resolvers.bridged_post import BridgedPost
 
-            return BridgedPost(self._context, result._asdict())
+            return BridgedPost(self._context, post._fields)
         return post
 
     @property
     def disputer(self):
-        personas = db.models.personas
-        stmt = sqlalchemy.select(personas).where(personas.c.id == self.disputer_id)
-        conn = self._context["db-conn"]
-        result = conn.execute(stmt).fetchone()
-        return Persona(self._context, result._asdict())
+        result = get_loaders(self._context).personas.load(self.disputer_id)
+        return Persona(self._context, result)
 
     @property
     def note_by_disputer(self):
@@ -5,6 +5,7 @@ import sqlalchemy
 from db.models import mod_reviews
 
 from api.content_mod import moderation_required
+from api.loaders import get_loaders
 from api.resolvers import Personas
 from api.time import time
 
@@ -57,6 +58,7 @@ class Review:
         for k, v in fields.items():
             setattr(self, k, v)
         self._initializing = False
+        get_loaders(context).personas.queue(fields.get("reviewer_id"))
 
     def __str__(self):
         return str(self._fields)
@@ -0,0 +1,64 @@
+"""
+Stand-in for the sending functions of firebase_admin.messaging, used by
+api.outbox.dispatch when FCM_BACKEND = "fake". Nothing leaves the process:
+messages and topic subscriptions are recorded, after a simulated latency,
+and a share of them can be made to fail to exercise the retries.
+"""
+
+import random
+import threading
+import time
+
+from firebase_admin import exceptions, messaging
+
+
+class FakeFCM:
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = []
+        self.topics = {}
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _fails(self):
+        return self._random.random() < self.failure_rate
+
+    def send_each(self, messages, dry_run=False, app=None):
+        time.sleep(self.latency)
+        responses = []
+        with self._lock:
+            self.calls += 1
+            for message in messages:
+                if self._fails():
+                    error = exceptions.UnavailableError("fake FCM failure")
+                    responses.append(messaging.SendResponse(None, error))
+                    continue
+                self.sent.append(message)
+                name = f"projects/fake/messages/{len(self.sent)}"
+                responses.append(messaging.SendResponse({"name": name}, None))
+        return messaging.BatchResponse(responses)
+
+    def subscribe_to_topic(self, tokens, topic, app=None):
+        return self._manage_topic(tokens, topic, subscribe=True)
+
+    def unsubscribe_from_topic(self, tokens, topic, app=None):
+        return self._manage_topic(tokens, topic, subscribe=False)
+
+    def _manage_topic(self, tokens, topic, subscribe):
+        time.sleep(self.latency)
+        results = []
+        with self._lock:
+            self.calls += 1
+            subscribed = self.topics.setdefault(topic, set())
+            for token in tokens:
+                if self._fails():
+                    results.append({"error": "UNAVAILABLE"})
+                    continue
+                if subscribe:
+                    subscribed.add(token)
+                else:
+                    subscribed.discard(token)
+                results.append({})
+        return messaging.TopicManagementResponse({"results": results})
@@ -0,0 +1,249 @@
+"""
+Per-request batching of the by-id lookups done by resolver relationships.
+
+Resolver objects queue the ids they reference as they are built (a Post
+queues its author_id, community_id and audio_id, ...). The first time one
+of those rows is actually needed, the loader fetches every queued id of
+that table with a single `WHERE <key> IN (...)` query, so resolving a page
+of N posts costs one query per table instead of N.
+
+Loaders hold plain row dicts. The resolver objects built from them are
+kept in an IdentityMap, so `Communities.get(context, id=1)` returns the same
+Community every time it is called within a request.
+"""
+
+import logging
+import os
+
+import db.models
+import sqlalchemy
+
+from api import cache
+from api.cache import TTLCache
+
+logger = logging.getLogger("api.loaders")
+
+# Communities and their flags change rarely and are read by most requests,
+# so the process also keeps them, see api.cache.
+COMMUNITY_CACHE_TTL = int(os.environ.get("COMMUNITY_CACHE_TTL", 5 * 60))
+community_rows = cache.register(
+    "communities", TTLCache(maxsize=2000, ttl=COMMUNITY_CACHE_TTL)
+)
+community_flags = cache.register(
+    "community_flags", TTLCache(maxsize=2000, ttl=COMMUNITY_CACHE_TTL)
+)
+
+_missing = object()
+
+
+class Loader:
+    """Loads rows of table by key.
+
+    With many=True, keys aren't unique and load returns the list of rows
+    with that key. With a process_cache, rows are read from it first, and
+    fetched rows are added to it, except for the keys invalidated in the
+    current transaction (see api.cache.invalidated).
+    """
+
+    def __init__(self, context, table, key="id", many=False, process_cache=None):
+        self._context = context
+        self._table = table
+        self._key = key
+        self._many = many
+        self._process_cache = process_cache
+        self._queued = set()
+        self._rows = {}
+
+    def queue(self, *keys):
+        """Registers keys to be fetched by the next load."""
+        for key in keys:
+            if key is not None and key not in self._rows:
+                self._queued.add(key)
+
+    def prime(self, row, replace=True):
+        """Stores a row fetched elsewhere, e.g. by a query on another column.
+        With replace=False, a row already loaded is kept."""
+        key = row[self._key]
+        if replace or key not in self._rows:
+            self._rows[key] = dict(row)
+        self._queued.discard(key)
+
+    def prime_missing(self, key):
+        """Records that there is no row with key."""
+        self._rows.setdefault(key, [] if self._many else None)
+        self._queued.discard(key)
+
+    def load(self, key):
+        """Returns the row dict for key, or None if there is no such row."""
+        if key is None:
+            return None
+        if key not in self._rows:
+            self._queued.add(key)
+            self._fetch()
+        return self._copy(self._rows.get(key))
+
+    def load_many(self, keys):
+        self.queue(*keys)
+        self._fetch()
+        return [self._copy(self._rows.get(key)) for key in keys]
+
+    def loaded(self):
+        """Returns every row loaded so far."""
+        self._fetch()
+        return [self._copy(row) for row in self._rows.values() if row is not None]
+
+    def _copy(self, row):
+        # resolver objects keep and sometimes modify their _fields.
+        if self._many:
+            return [dict(r) for r in row] if row is not None else []
+        return dict(row) if row is not None else None
+
+    def clear(self, key):
+        self._rows.pop(key, None)
+
+    def clear_row(self, row_id):
+        """Forgets any cached row whose primary key is row_id."""
+        if self._key == "id":
+            self.clear(row_id)
+            return
+        stale = [
+            k
+            for k, row in self._rows.items()
+            if row and row_id in [r["id"] for r in (row if self._many else [row])]
+        ]
+        for key in stale:
+            del self._rows[key]
+
+    def _fetch(self):
+        keys = self._queued - set(self._rows)
+        self._queued = set()
+        conn = self._context["db-conn"]
+        cached = set()
+        if self._process_cache is not None:
+            cached = {
+                key
+                for key in keys
+                if not cache.invalidated(conn, self._table.name, key)
+            }
+            for key in cached:
+                row = self._process_cache.get(key, _missing)
+                if row is not _missing:
+                    self._rows[key] = row
+                    keys.discard(key)
+        if not keys:
+            return
+
+        column = self._table.c[self._key]
+        stmt = sqlalchemy.select(self._table).where(column.in_(sorted(keys)))
+        if self._many:
+            stmt = stmt.order_by(self._table.c.id)
+        for row in conn.execute(stmt):
+            row = row._asdict()
+            if self._many:
+                self._rows.setdefault(row[self._key], []).append(row)
+            else:
+                # keys might not be unique (e.g. rounds.prompt_id), keep the first.
+                self._rows.setdefault(row[self._key], row)
+
+        # remember misses so they aren't queried again in this request.
+        for key in keys:
+            self._rows.setdefault(key, [] if self._many else None)
+            if key in cached and self._rows[key] is not None:
+                self._process_cache.set(key, self._rows[key])
+        logger.debug("loaded %s %s rows", len(keys), self._table.name)
+
+
+class IdentityMap:
+    """One resolver object per (table, id) within a request."""
+
+    def __init__(self):
+        self._objects = {}
+
+    def get(self, table, row_id):
+        return self._objects.get((table, row_id))
+
+    def get_or_build(self, table, fields, build):
+        """Returns the object already built for fields["id"], or stores and
+        returns build(fields)."""
+        key = (table, fields["id"])
+        if key not in self._objects:
+            self._objects[key] = build(fields)
+        return self._objects[key]
+
+    def discard(self, table, row_id):
+        self._objects.pop((table, row_id), None)
+
+
+class Loaders:
+    def __init__(self, context):
+        models = db.models
+        self.identity_map = IdentityMap()
+        self.personas = Loader(context, models.personas)
+        self.personas_by_pkh = Loader(context, models.personas, key="pkh")
+        self.communities = Loader(
+            context, models.communities, process_cache=community_rows
+        )
+        self.community_flags = Loader(
+            context,
+            models.community_flags,
+            key="community_id",
+            many=True,
+            process_cache=community_flags,
+        )
+        self.posts = Loader(context, models.posts)
+        self.prompts = Loader(context, models.prompts)
+        self.prompts_by_post = Loader(context, models.prompts, key="post_id")
+        self.rounds = Loader(context, models.rounds)
+        self.rounds_by_prompt = Loader(context, models.rounds, key="prompt_id")
+        self.audios = Loader(context, models.audios)
+        self.audio_transcripts = Loader(
+            context, models.audio_transcripts, key="audio_id"
+        )
+        self.images = Loader(context, models.images)
+        self.frequency_metadata = Loader(
+            context, models.frequency_metadata, key="persona_id"
+        )
+        # (persona_id, community_id) -> roles and permission patches,
+        # see Persona.membership_permissions.
+        self.memberships = {}
+
+    def _loaders_of(self, table):
+        return [
+            loader
+            for loader in vars(self).values()
+            if isinstance(loader, Loader) and loader._table.name == table
+        ]
+
+    def prime(self, table, row, replace=True):
+        """Stores a row fetched elsewhere in every loader reading that table.
+        With replace=False, rows and objects already loaded are kept."""
+        if replace:
+            self.identity_map.discard(table, row["id"])
+        for loader in self._loaders_of(table):
+            loader.prime(row, replace)
+
+    def prime_missing(self, table, key, value):
+        """Records that table has no row whose key is value."""
+        for loader in self._loaders_of(table):
+            if loader._key == key:
+                loader.prime_missing(value)
+
+    def clear(self, table, row_id):
+        """Forgets row_id of table in every loader reading that table, and the
+        object built from it. Mutations call this so later reads in the
+        request see the new values.
+        """
+        self.identity_map.discard(table, row_id)
+        for loader in self._loaders_of(table):
+            loader.clear_row(row_id)
+
+
+def get_loaders(context):
+    """Returns the loaders of this context.
+
+    DbTransactionExtension sets one per request; contexts built by workers,
+    tasks and tests get theirs on first use.
+    """
+    if "loaders" not in context:
+        context["loaders"] = Loaders(context)
+    return context["loaders"]
@@ -4,9 +4,14 @@ In this file we handle different notification topics, one topic per community.
 
 import os
 import logging
-from firebase_admin import messaging
-from api.resolvers import Communities
+
+import db.models as models
 from dotenv import load_dotenv
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from api import outbox
+from api.time import time
 
 load_dotenv()
 
@@ -20,59 +25,69 @@ logger.info(f"NOTIFICATIONS_ALIAS {notif_topic_prefix}")
 
 
 def handle_community_notification(persona, community, mode):
-    logger.info("CALLING handle_community_notification PRE")
-    modes = {
-        "register": messaging.subscribe_to_topic,
-        "unregister": messaging.unsubscribe_from_topic,
-    }
-
-    persona_token = persona.notification_token
-    if persona_token is None:
-        return False
-    persona_token = persona_token.token
+    """
+    (Un)subscribes persona's token to community's topic once the caller's
+    transaction commits, see api.outbox. Subscriptions are kept in
+    fcm_topic_subscriptions for handle_revoke_token.
+    """
+    return handle_community_notifications(persona._context, [persona], community, mode)
 
-    topic = notif_topic_prefix + community.notif_all_members_topic
-    response = modes[mode](tokens=[persona_token], topic=topic)
 
-    assert (
-        response.failure_count == 0 and response.success_count == 1
-    ), f"Coulnd't {mode} FCMToken for Persona.id {persona.id} in topic {topic}."
-    logger.info(
-        f"Success in {mode} FCMToken for Persona.id {persona.id} in topic {topic}."
+def handle_community_notifications(context, personas, community, mode):
+    """
+    Same as handle_community_notification for each of personas, with one
+    statement per table. Returns whether any of them has a token.
+    """
+    modes = {"register": "subscribe", "unregister": "unsubscribe"}
+    conn = context["db-conn"]
+
+    # the most recent token of each persona, see Persona.notification_token.
+    tokens_model = models.fcm_tokens
+    stmt = (
+        select(tokens_model.c.token)
+        .distinct(tokens_model.c.persona_id)
+        .where(tokens_model.c.persona_id.in_([persona.id for persona in personas]))
+        .order_by(tokens_model.c.persona_id, tokens_model.c.creation_time.desc())
     )
-    return True
-
+    tokens = conn.execute(stmt).scalars().all()
+    if not tokens:
+        return False
 
-def handle_revoke_token(context, token):
-    if revoke_token(token):
-        return True
-
-    # TODO: read below.
-    # must keep track of all notifications
-    # must run when the user logs out!
-    communities = Communities(context).all()
-    for c in communities:
-        topic = notif_topic_prefix + c.notif_all_members_topic
-        response = messaging.unsubscribe_from_topic(tokens=[token], topic=topic)
-        if response.failure_count != 0:
-            logger.error(f"Coulnd't revoke token from topic {topic}.")
-
-    logger.info(f"Success in handle_revoke_token for token {token[:20]}...")
+    topic = notif_topic_prefix + community.notif_all_members_topic
+    subscriptions = models.fcm_topic_subscriptions
+    if mode == "register":
+        now = time.utcnow()
+        stmt = insert(subscriptions).values(
+            [{"token": token, "topic": topic, "creation_time": now} for token in tokens]
+        )
+        stmt = stmt.on_conflict_do_nothing()
+    else:
+        stmt = delete(subscriptions).where(
+            subscriptions.c.token.in_(tokens) & (subscriptions.c.topic == topic)
+        )
+    conn.execute(stmt)
+    outbox.enqueue_tokens(context, modes[mode], topic, tokens)
+    logger.info(f"Queued {mode} of {len(tokens)} FCMTokens in topic {topic}.")
     return True
 
 
-def revoke_token(token):
+def handle_revoke_token(context, token):
     """
-    TODO: implement this.
-    Wondering if there is a more efficient method to revoke tokens.
-
-    Also, it's important to save the token to the server and update the
-    timestamp whenever it changes, such as when:
-
-    The app is restored on a new device
-    The user uninstalls/reinstall the app
-    The user clears app data.
-
-    src: https://firebase.google.com/docs/cloud-messaging/manage-tokens
+    Unsubscribes token from the topics it was subscribed to, once the
+    caller's transaction commits. The dispatcher batches them per topic.
     """
-    return False
+    subscriptions = models.fcm_topic_subscriptions
+    stmt = (
+        delete(subscriptions)
+        .where(subscriptions.c.token == token)
+        .returning(subscriptions.c.topic)
+    )
+    topics = context["db-conn"].execute(stmt).scalars().all()
+    for topic in topics:
+        outbox.enqueue(context, "unsubscribe", topic, token=token)
+
+    logger.info(
+        f"Success in handle_revoke_token for token {token[:20]}..., "
+        f"{len(topics)} topics"
+    )
+    return True
@@ -6,6 +6,8 @@ import firebase_admin
 from firebase_admin import credentials, messaging
 from dotenv import load_dotenv
 
+from api import outbox
+
 load_dotenv()
 logger = logging.getLogger("api.notif")
 notifications_alias = os.environ["NOTIFICATIONS_ALIAS"]
@@ -44,16 +46,19 @@ def check_permission(func):
     return wrapper
 
 
-def prevent_concurrency(notif_type):
-    prev_calls = set()
+def claim_notification(notif_type):
+    """
+    Sends the notification only if this call is the one marking
+    round.<notif_type> as sent, so concurrent workers and API instances
+    don't send it twice. The mark is part of the caller's transaction,
+    as is the notification added to the outbox.
+    """
 
     def wrapper(func):
         @functools.wraps(func)
         def wrapper(round, community):
-            current_call = round.id
-            if current_call in prev_calls:
-                return None
-            prev_calls.add(current_call)
+            if not round.mark_notification_as_sent(notif_type):
+                return False
             return func(round, community)
 
         return wrapper
@@ -71,56 +76,26 @@ def ping():
 
 
 @check_permission
-@prevent_concurrency("start_notif_sent")
+@claim_notification("start_notif_sent")
 def send_new_round_notification(round, community):
     """
     Intended to be called only when a new round becomes active.
+    Sent by api.outbox once the round is committed.
     """
-    # FIXME: round should include Round.community
-    logger.info(
-        "\n\n#########\n"
-        + f"CALLING send_new_round_notification for round.id {round.id}, sent {round.start_notif_sent}"
-        + "\n##########"
-    )
-
-    if round.start_notif_sent:
-        return False
-    round.mark_notification_as_sent("start_notif_sent")
-
-    title_ = f"{round.prompt.post.author.name} in {community.name}!"
-    body_ = f'"{round.prompt.post.text}"'
-
-    message = messaging.Message(
-        notification=messaging.Notification(title=title_, body=body_),
-        topic=notifications_alias + community.notif_all_members_topic,
-    )
-    response = messaging.send(message)
-    return response
+    logger.info(f"new round notification queued for round.id {round.id}")
+    topic = notifications_alias + community.notif_all_members_topic
+    outbox.enqueue(round._context, "new_round", topic, round_id=round.id)
+    return True
 
 
 @check_permission
-@prevent_concurrency("completion_notif_sent")
+@claim_notification("completion_notif_sent")
 def send_round_has_closed_notification(round, community):
     """
     Intended to be called only when a round trasitions to closed.
+    Sent by api.outbox once the transition is committed.
     """
-    # FIXME: round should include Round.community
-    logger.info(
-        "\n\n#########\n"
-        + f"CALLING send_round_has_closed_notification for round.id {round.id}, sent {round.completion_notif_sent}"
-        + "\n##########"
-    )
-
-    if round.completion_notif_sent:
-        return False
-    round.mark_notification_as_sent("completion_notif_sent")
-
-    title_ = f"You can now see everyone's replies in {community.name}!"
-    body_ = f'"{round.prompt.post.text}"'
-
-    message = messaging.Message(
-        notification=messaging.Notification(title=title_, body=body_),
-        topic=notifications_alias + community.notif_all_members_topic,
-    )
-    response = messaging.send(message)
-    return response
+    logger.info(f"round closed notification queued for round.id {round.id}")
+    topic = notifications_alias + community.notif_all_members_topic
+    outbox.enqueue(round._context, "round_closed", topic, round_id=round.id)
+    return True
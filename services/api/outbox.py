@@ -0,0 +1,349 @@
+"""
+Outbox of the notifications sent through Firebase Cloud Messaging (FCM).
+
+Mutations don't call FCM themselves: enqueue adds a row to
+notification_outbox on the mutation's own transaction, so a notification
+goes out if and only if the change that caused it commits. Pending rows with
+the same dedupe_key are coalesced, e.g. a persona joining and leaving a
+community before the dispatch only keeps the last subscription change.
+
+dispatch sends the pending rows with the FCM batch APIs: send_each for the
+round notifications, whose titles and bodies are built with one joined
+query, and one subscribe or unsubscribe call per topic for the tokens. A row
+is retried with exponential backoff until it is sent or reaches MAX_ATTEMPTS.
+Rows sent or given up on are deleted RETENTION seconds later, see prune.
+
+A request that enqueued notifications dispatches them itself before it
+returns, see api.DbTransactionExtension: on Lambda, the process is frozen
+once the response is sent, so nothing can be left running in the
+background. Rows that fail or are left over are sent by the round worker,
+which calls dispatch_all every run.
+
+With FCM_BACKEND = "fake", rows are handed to api.fake_fcm.FakeFCM instead,
+which lets the dispatcher run and be load-tested offline.
+"""
+
+import logging
+import os
+
+import db.models
+import sqlalchemy
+from firebase_admin import messaging
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from api.fake_fcm import FakeFCM
+from api.time import time
+
+logger = logging.getLogger("api.outbox")
+
+FCM_BACKEND = os.getenv("FCM_BACKEND", "firebase")
+# rows claimed by each dispatch.
+BATCH_SIZE = 1000
+# FCM limits: messages per send_each, tokens per topic (un)subscription.
+SEND_EACH_LIMIT = 500
+TOPIC_LIMIT = 1000
+# a failed row is retried after RETRY_DELAY * 2^attempts seconds.
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 60 * 60
+MAX_ATTEMPTS = 8
+# sent and failed rows are kept this long, in seconds.
+RETENTION = 7 * 24 * 60 * 60
+
+_fake_fcm = None
+
+
+def fcm_client():
+    """Returns what sends to FCM, see FCM_BACKEND."""
+    global _fake_fcm
+    if FCM_BACKEND == "fake":
+        if _fake_fcm is None:
+            _fake_fcm = FakeFCM()
+        return _fake_fcm
+    return messaging
+
+
+def dedupe_key(kind, topic, round_id=None, token=None):
+    if kind in ["subscribe", "unsubscribe"]:
+        # the last change of a token's subscription to a topic wins.
+        return f"topic:{topic}:{token}"
+    return f"{kind}:{round_id}"
+
+
+def enqueue(context, kind, topic, round_id=None, token=None):
+    """
+    Adds a notification to the outbox on context's transaction, or updates
+    the pending one with the same dedupe_key.
+    """
+    _insert(context, kind, topic, [(round_id, token)])
+
+
+def enqueue_tokens(context, kind, topic, tokens):
+    """Same as enqueue for the (un)subscription of each of tokens to topic,
+    with one statement."""
+    _insert(context, kind, topic, [(None, token) for token in tokens])
+
+
+def _insert(context, kind, topic, targets):
+    outbox = db.models.notification_outbox
+    now = time.utcnow()
+    # a statement can't update the same pending row twice.
+    rows = {}
+    for round_id, token in targets:
+        key = dedupe_key(kind, topic, round_id, token)
+        rows[key] = {
+            "kind": kind,
+            "dedupe_key": key,
+            "topic": topic,
+            "round_id": round_id,
+            "token": token,
+            "creation_time": now,
+            "next_attempt_time": now,
+        }
+    if not rows:
+        return
+    stmt = insert(outbox).values(list(rows.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[outbox.c.dedupe_key],
+        index_where=outbox.c.sent_time.is_(None),
+        set_={
+            "kind": stmt.excluded.kind,
+            "attempts": 0,
+            "next_attempt_time": stmt.excluded.next_attempt_time,
+            "error": None,
+        },
+    )
+    context["db-conn"].execute(stmt)
+    # lets DbTransactionExtension dispatch once the request commits.
+    context["outbox-pending"] = True
+
+
+def retry_delay(attempts):
+    return min(RETRY_DELAY * 2**attempts, MAX_RETRY_DELAY)
+
+
+def _claim(conn, now, limit):
+    """
+    Claims up to limit pending rows: their attempts are counted and their
+    next attempt is scheduled right away, so a dispatcher that dies while
+    sending doesn't lose them, and others skip them meanwhile.
+    """
+    outbox = db.models.notification_outbox
+    pending = (
+        select(outbox.c.id)
+        .where(outbox.c.sent_time.is_(None))
+        .where(outbox.c.attempts < MAX_ATTEMPTS)
+        .where(outbox.c.next_attempt_time <= now)
+        .order_by(outbox.c.next_attempt_time)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    retry_time = sqlalchemy.case(
+        {
+            attempts: bindparam(
+                None,
+                now.shift(seconds=retry_delay(attempts)),
+                type_=outbox.c.next_attempt_time.type,
+            )
+            for attempts in range(MAX_ATTEMPTS)
+        },
+        value=outbox.c.attempts,
+    )
+    stmt = (
+        update(outbox)
+        .where(outbox.c.id.in_(pending.scalar_subquery()))
+        .values(attempts=outbox.c.attempts + 1, next_attempt_time=retry_time)
+        .returning(outbox)
+    )
+    rows = [row._asdict() for row in conn.execute(stmt)]
+    conn.commit()
+    return rows
+
+
+def _round_payloads(conn, round_ids):
+    """Returns {round_id: (community name, author name, prompt text)}."""
+    models = db.models
+    stmt = (
+        select(
+            models.rounds.c.id,
+            models.communities.c.name,
+            models.personas.c.name,
+            models.posts.c.text,
+        )
+        .select_from(models.rounds)
+        .join(
+            models.communities, models.communities.c.id == models.rounds.c.community_id
+        )
+        .join(models.prompts, models.prompts.c.id == models.rounds.c.prompt_id)
+        .join(models.posts, models.posts.c.id == models.prompts.c.post_id)
+        .join(models.personas, models.personas.c.id == models.posts.c.author_id)
+        .where(models.rounds.c.id.in_(round_ids))
+    )
+    return {row[0]: tuple(row[1:]) for row in conn.execute(stmt)}
+
+
+def _message(row, payload):
+    community_name, author_name, text = payload
+    if row["kind"] == "new_round":
+        title = f"{author_name} in {community_name}!"
+    else:
+        title = f"You can now see everyone's replies in {community_name}!"
+    return messaging.Message(
+        notification=messaging.Notification(title=title, body=f'"{text}"'),
+        topic=row["topic"],
+    )
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _send_messages(client, rows, payloads, failed):
+    messages = []
+    for row in rows:
+        payload = payloads.get(row["round_id"])
+        if payload is None:
+            failed[row["id"]] = f"round {row['round_id']} has no prompt"
+        else:
+            messages.append((row, _message(row, payload)))
+
+    for chunk in _chunks(messages, SEND_EACH_LIMIT):
+        try:
+            response = client.send_each([message for _, message in chunk])
+        except Exception as e:
+            logger.exception("send_each failed")
+            for row, _ in chunk:
+                failed[row["id"]] = str(e)
+            continue
+        for (row, _), result in zip(chunk, response.responses):
+            if not result.success:
+                failed[row["id"]] = str(result.exception)
+
+
+def _manage_topics(client, rows, failed):
+    by_topic = {}
+    for row in rows:
+        by_topic.setdefault((row["kind"], row["topic"]), []).append(row)
+
+    for (kind, topic), topic_rows in by_topic.items():
+        manage = (
+            client.subscribe_to_topic
+            if kind == "subscribe"
+            else client.unsubscribe_from_topic
+        )
+        for chunk in _chunks(topic_rows, TOPIC_LIMIT):
+            try:
+                response = manage([row["token"] for row in chunk], topic)
+            except Exception as e:
+                logger.exception(f"{kind} to {topic} failed")
+                for row in chunk:
+                    failed[row["id"]] = str(e)
+                continue
+            for error in response.errors:
+                failed[chunk[error.index]["id"]] = error.reason
+
+
+def _record(conn, rows, failed, now):
+    # rows coalesced with a newer event meanwhile had their attempts reset,
+    # they are left pending to be sent again.
+    outbox = db.models.notification_outbox
+    matches = (outbox.c.id == bindparam("row_id")) & (
+        outbox.c.attempts == bindparam("row_attempts")
+    )
+    sent = [
+        {"row_id": row["id"], "row_attempts": row["attempts"]}
+        for row in rows
+        if row["id"] not in failed
+    ]
+    errors = [
+        {
+            "row_id": row["id"],
+            "row_attempts": row["attempts"],
+            "row_error": failed[row["id"]],
+        }
+        for row in rows
+        if row["id"] in failed
+    ]
+    if sent:
+        conn.execute(update(outbox).where(matches).values(sent_time=now), sent)
+    if errors:
+        stmt = update(outbox).where(matches).values(error=bindparam("row_error"))
+        conn.execute(stmt, errors)
+    conn.commit()
+
+
+def dispatch(context, client=None, limit=BATCH_SIZE):
+    """
+    Sends up to limit pending notifications.
+    Returns the number of rows sent and failed.
+    """
+    client = client or fcm_client()
+    conn = context["db-conn"]
+    now = time.utcnow()
+    rows = _claim(conn, now, limit)
+    if not rows:
+        return {"sent": 0, "failed": 0}
+
+    failed = {}
+    rounds = [row for row in rows if row["round_id"] is not None]
+    topics = [row for row in rows if row["round_id"] is None]
+    if rounds:
+        payloads = _round_payloads(conn, {row["round_id"] for row in rounds})
+        _send_messages(client, rounds, payloads, failed)
+    if topics:
+        _manage_topics(client, topics, failed)
+
+    _record(conn, rows, failed, time.utcnow())
+    counts = {"sent": len(rows) - len(failed), "failed": len(failed)}
+    logger.info(f"outbox dispatched {counts}")
+    return counts
+
+
+def prune(context, now, limit=BATCH_SIZE):
+    """
+    Deletes up to limit rows, oldest first, that were sent or reached
+    MAX_ATTEMPTS more than RETENTION seconds before now. The rows given up
+    on would otherwise stay in outbox_pending_index.
+    Returns the number of rows deleted.
+    """
+    outbox = db.models.notification_outbox
+    cutoff = now.shift(seconds=-RETENTION)
+    done = sqlalchemy.or_(
+        outbox.c.sent_time < cutoff,
+        sqlalchemy.and_(
+            outbox.c.sent_time.is_(None),
+            outbox.c.attempts >= MAX_ATTEMPTS,
+            outbox.c.next_attempt_time < cutoff,
+        ),
+    )
+    old = (
+        select(outbox.c.id)
+        .where(done)
+        .order_by(outbox.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    conn = context["db-conn"]
+    result = conn.execute(
+        sqlalchemy.delete(outbox).where(outbox.c.id.in_(old.scalar_subquery()))
+    )
+    conn.commit()
+    return result.rowcount
+
+
+def dispatch_all(engine, client=None):
+    """Dispatches until no pending notification is due, then prunes the
+    rows past their retention."""
+    total = {"sent": 0, "failed": 0}
+    with engine.connect() as conn:
+        context = {"db-conn": conn}
+        while True:
+            counts = dispatch(context, client)
+            for k in total:
+                total[k] += counts[k]
+            if counts["sent"] + counts["failed"] < BATCH_SIZE:
+                break
+        while prune(context, time.utcnow()) == BATCH_SIZE:
+            pass
+        return total
@@ -0,0 +1,156 @@
+"""
+Plans the SQL of a GraphQL query from the fields the client selected.
+
+selections(info) turns the selection sets of the field being resolved into a
+tree, {field name: subtree}, with fragments merged in. RELATIONSHIPS lists,
+per GraphQL type, the fields that resolvers read from a single row of
+another table: Post.author is the personas row whose id is posts.author_id,
+Persona.msa_handle comes from the frequency_metadata row whose persona_id is
+personas.id, and so on.
+
+prime(context, type_name, ids, tree) then fetches, for the rows ids of
+type_name, the rows of every selected relationship, and of theirs, with one
+LEFT OUTER JOIN query, and stores them in the request's loaders (see
+api/loaders.py). Resolvers find them there instead of querying each table.
+
+Fields computed by resolvers (Community.active_round, Prompt.num_replies,
+lists such as Community.members, ...) aren't planned; they are still loaded
+when resolved.
+"""
+
+import logging
+
+import db.models as models
+import sqlalchemy
+from graphql import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+from api.loaders import get_loaders
+
+logger = logging.getLogger("api.planner")
+
+TABLES = {
+    "Audio": models.audios,
+    "AudioTranscript": models.audio_transcripts,
+    "Community": models.communities,
+    "Dispute": models.mod_disputes,
+    "FrequencyMetadata": models.frequency_metadata,
+    "Image": models.images,
+    "Persona": models.personas,
+    "Post": models.posts,
+    "Prompt": models.prompts,
+    "Round": models.rounds,
+}
+
+# type -> {field: (related type, column, related column)}, the field being
+# the row of the related type whose related column equals column.
+RELATIONSHIPS = {
+    "Audio": {
+        "transcripts": ("AudioTranscript", "id", "audio_id"),
+        "plain_transcript": ("AudioTranscript", "id", "audio_id"),
+        "wave_values": ("AudioTranscript", "id", "audio_id"),
+    },
+    "Dispute": {
+        "post": ("Post", "post_id", "id"),
+        "disputer": ("Persona", "disputer_id", "id"),
+    },
+    "Persona": {
+        "image": ("Image", "image_id", "id"),
+        "msa_handle": ("FrequencyMetadata", "id", "persona_id"),
+    },
+    "Post": {
+        "author": ("Persona", "author_id", "id"),
+        "audio": ("Audio", "audio_id", "id"),
+        "community": ("Community", "community_id", "id"),
+        "prompt": ("Prompt", "id", "post_id"),
+    },
+    "Prompt": {
+        "post": ("Post", "post_id", "id"),
+        "round": ("Round", "id", "prompt_id"),
+    },
+    "Round": {
+        "prompt": ("Prompt", "prompt_id", "id"),
+    },
+}
+
+
+def selections(info, *path):
+    """
+    Returns the tree of fields selected below the field being resolved,
+    or below path within it, e.g. selections(info, "edges", "node").
+    """
+    tree = {}
+    for field_node in info.field_nodes:
+        _merge(tree, field_node.selection_set, info.fragments)
+    for name in path:
+        tree = tree.get(name) or {}
+    return tree
+
+
+def _merge(tree, selection_set, fragments):
+    if selection_set is None:
+        return
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            subtree = tree.setdefault(selection.name.value, {})
+            _merge(subtree, selection.selection_set, fragments)
+        elif isinstance(selection, FragmentSpreadNode):
+            fragment = fragments[selection.name.value]
+            _merge(tree, fragment.selection_set, fragments)
+        elif isinstance(selection, InlineFragmentNode):
+            _merge(tree, selection.selection_set, fragments)
+
+
+def _joins(type_name, table, tree):
+    """Yields (parent, relationship, related table) for the selected
+    relationships of tree, parents first."""
+    joined = set()
+    for field, relationship in RELATIONSHIPS.get(type_name, {}).items():
+        # fields read from the same row share its join.
+        if field not in tree or relationship in joined:
+            continue
+        joined.add(relationship)
+        related_type = relationship[0]
+        related = TABLES[related_type].alias(f"{table.name}_{field}")
+        yield table, relationship, related
+        yield from _joins(related_type, related, tree[field])
+
+
+def prime(context, type_name, ids, tree):
+    """
+    Loads the relationships selected in tree of the type_name rows ids with
+    one query, and stores them in the request's loaders. Rows the loaders
+    already have are kept.
+    """
+    ids = sorted({id for id in ids if id is not None})
+    base = TABLES[type_name]
+    joins = list(_joins(type_name, base, tree))
+    if not ids or not joins:
+        return
+
+    from_ = base
+    for parent, (_, column, related_column), related in joins:
+        from_ = from_.outerjoin(related, related.c[related_column] == parent.c[column])
+    columns = [parent.c[column] for parent, (_, column, _), _ in joins]
+    for _, _, related in joins:
+        columns.extend(related.c)
+    stmt = (
+        sqlalchemy.select(*columns)
+        .select_from(from_)
+        .where(base.c.id.in_(ids))
+        .set_label_style(sqlalchemy.LABEL_STYLE_TABLENAME_PLUS_COL)
+    )
+
+    loaders = get_loaders(context)
+    for row in context["db-conn"].execute(stmt):
+        row = row._mapping
+        for parent, (_, column, related_column), related in joins:
+            key = row[parent.c[column]]
+            if key is None:
+                continue
+            fields = {c.key: row[c] for c in related.c}
+            table = related.element.name
+            if fields["id"] is None:
+                loaders.prime_missing(table, related_column, key)
+            else:
+                loaders.prime(table, fields, replace=False)
+    logger.debug("planned %s %s rows: %s", len(ids), type_name, len(joins))
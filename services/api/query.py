@@ -9,6 +9,7 @@ from ariadne import QueryType, MutationType
 import api.resolvers as resolvers
 import api.content_mod.resolvers as mod_resolvers
 import api.bridged_round.resolvers as b_round_resolvers
+from api import planner
 from api.version import VERSION
 from api.time import time
 
@@ -41,6 +42,13 @@ def wrap(root, qtype):
     return wrap
 
 
+def plan(info, type_name, objs, *path):
+    """Loads the relationships of objs selected by the query, see api.planner."""
+    tree = planner.selections(info, *path)
+    ids = [obj.id for obj in objs if obj is not None]
+    planner.prime(info.context, type_name, ids, tree)
+
+
 @wrap(query, "ping")
 def resolve_hello(_, info):
     logger.info("auth0: %s", info.context["auth0"])
@@ -81,7 +89,9 @@ def resolve_rounds(
     _, info, how_many=None, status=None, prompt_id=None, community_id=None
 ):
     rounds = resolvers.Rounds(info.context, how_many, status, prompt_id, community_id)
-    return rounds.all()
+    rounds = rounds.all()
+    plan(info, "Round", rounds)
+    return rounds
 
 
 @wrap(query, "siwfURI")
@@ -297,6 +307,50 @@ def resolve_register_perm_in_community(_, info, pkh, community_id, perm, mode):
     return response
 
 
+def for_pkhs(context, pkhs, handle):
+    """Calls handle with the personas of pkhs, loaded with one query, and
+    returns its response for each pkh."""
+    personas = resolvers.Personas.get_many(context, pkhs)
+    responses = iter(handle([persona for persona in personas if persona]))
+    return [
+        next(responses) if persona else f"Persona {pkh} doesn't exist"
+        for pkh, persona in zip(pkhs, personas)
+    ]
+
+
+@wrap(mutation, "registerPkhsToCommunity")
+def resolve_register_pkhs_to_community(_, info, pkhs, community_id, mode):
+    logger.info(f"Calling registerPkhsToCommunity for community.id {community_id}")
+    community = resolvers.Communities.get(info.context, community_id)
+    return for_pkhs(
+        info.context,
+        pkhs,
+        lambda personas: community.handle_registrations(personas, mode),
+    )
+
+
+@wrap(mutation, "registerPkhsRoleInCommunity")
+def resolve_register_pkhs_role_in_community(_, info, pkhs, community_id, role, mode):
+    logger.info(f"Calling registerPkhsRoleInCommunity for community.id {community_id}")
+    community = resolvers.Communities.get(info.context, community_id)
+    return for_pkhs(
+        info.context,
+        pkhs,
+        lambda personas: community.handle_roles(personas, role, mode),
+    )
+
+
+@wrap(mutation, "registerPkhsPermInCommunity")
+def resolve_register_pkhs_perm_in_community(_, info, pkhs, community_id, perm, mode):
+    logger.info(f"Calling registerPkhsPermInCommunity for community.id {community_id}")
+    community = resolvers.Communities.get(info.context, community_id)
+    return for_pkhs(
+        info.context,
+        pkhs,
+        lambda personas: community.handle_permissions(personas, perm, mode),
+    )
+
+
 @wrap(mutation, "registeFlagInCommunity")
 def resolve_register_flag_in_community(_, info, community_id, flag, mode):
     logger.info(f"Calling registeFlagInCommunity for community.id {community_id}")
@@ -341,8 +395,7 @@ def resolve_post(_, info, id):
 def resolve_prompt_replies(_, info, prompt_id, first=None, after=None):
     logger.info(f"Calling GET pagedPromptReplies for prompt.id {prompt_id}")
     prompt = resolvers.Prompts.get(info.context, prompt_id)
-    replies = prompt.get_replies(first, after)
-    return replies
+    return prompt.get_replies(first, after).plan(info, "Post")
 
 
 @wrap(query, "audio")
@@ -515,7 +568,7 @@ def resolve_force_mode_check_posts(_, info, community_id):
     pkh = get_auth_pkh(info.context)
     persona = resolvers.Personas.get(info.context, pkh=pkh)
     community = resolvers.Communities.get(info.context, community_id)
-    active_replies = community.active_round.prompt.replies
+    active_replies = community.active_round.prompt.get_replies(None).nodes
     response = {
         "mods": persona.run_ai_mod(
             community=community, posts=active_replies, request_mod_reviews=True
@@ -558,6 +611,7 @@ def resolve_get_community_disputes(_, info, community_id):
     disputes = mod_resolvers.Disputes(
         info.context, community=community, status="pending"
     ).all()
+    plan(info, "Dispute", disputes)
     return disputes
 
 
@@ -1,11 +1,15 @@
 import json
 import logging
+from functools import cached_property
 
 import db.models as models
 import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
 
 from api.assets import AudioBucket
 from api.exceptions import AudioUploadError
+from api.loaders import get_loaders
+from api.resolvers.prompts import refresh_reply_counts
 from api.time import time
 
 logger = logging.getLogger("api.audios")
@@ -64,8 +68,7 @@ class Audios:
         """
         This method returs an Audio.
         """
-        stmt = sqlalchemy.select(models.audios).where(models.audios.c.id == id)
-        fetched_audio = context["db-conn"].execute(stmt).fetchone()
+        fetched_audio = get_loaders(context).audios.load(id)
         if fetched_audio is None:
             return Audio(
                 context,
@@ -79,7 +82,7 @@ class Audios:
             )
             # raise Exception(f"Audio.id {id} doesn't exist")
 
-        return Audio(context, fetched_audio._asdict())
+        return Audio(context, fetched_audio)
 
     @classmethod
     def update(_, context, id, values):
@@ -93,9 +96,45 @@ class Audios:
             .values(**values)
         )
         conn.execute(stmt)
+        if "available_mp3" in values:
+            posts = models.posts
+            replied = sqlalchemy.select(posts.c.in_reply_to).where(
+                posts.c.audio_id == id
+            )
+            refresh_reply_counts(context, replied)
         conn.commit()
+        get_loaders(context).clear("audios", id)
         return Audios.get(context, id)
 
+    @classmethod
+    def update_transcripts(_, context, id, vtt=None, wave_values=None):
+        """
+        Stores the transcripts and wave values of an Audio, the ones left
+        as None are kept.
+        """
+        values = {}
+        if vtt is not None:
+            values["vtt"] = json.dumps(vtt)
+            values["plain_transcript"] = plain_transcript(vtt)
+        if wave_values is not None:
+            values["wave_values"] = json.dumps(wave_values)
+        if not values:
+            return
+
+        transcripts = models.audio_transcripts
+        stmt = insert(transcripts).values(
+            audio_id=id, creation_time=time.utcnow(), **values
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[transcripts.c.audio_id], set_=values
+        )
+        context["db-conn"].execute(stmt)
+        get_loaders(context).audio_transcripts.clear(id)
+
+
+def plain_transcript(vtt):
+    return " ".join(_["text"] for _ in vtt).strip()
+
 
 class Audio:
     def __init__(self, context, fields):
@@ -104,6 +143,7 @@ class Audio:
         self._bucket = AudioBucket()
         for k, v in fields.items():
             setattr(self, k, v)
+        get_loaders(context).audio_transcripts.queue(fields.get("id"))
 
     @property
     def post(self):
@@ -138,17 +178,24 @@ class Audio:
             return json.loads(self.info)
         return {}
 
-    @property
+    @cached_property
+    def _transcripts(self):
+        # loaded for every audio of the request at once, and only if read.
+        return get_loaders(self._context).audio_transcripts.load(self.id) or {}
+
+    @cached_property
     def wave_values(self):
-        return self.info_dict.get("wave_values", [])
+        wave_values = self._transcripts.get("wave_values")
+        return json.loads(wave_values) if wave_values else []
 
-    @property
+    @cached_property
     def transcripts(self):
-        return self.info_dict.get("transcripts_vtt", [])
+        vtt = self._transcripts.get("vtt")
+        return json.loads(vtt) if vtt else []
 
     @property
     def plain_transcript(self):
-        return " ".join(_["text"] for _ in self.transcripts).strip()
+        return self._transcripts.get("plain_transcript") or ""
 
     @property
     def mp3(self):
@@ -1,11 +1,18 @@
 import json
 import logging
+from contextlib import contextmanager
+from functools import cached_property
 
 import db.models
 import sqlalchemy
 from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert
 
 import api.resolvers
+from api.cache import invalidate
+from api.connections import DEFAULT_FIRST, Connection
+from api.loaders import get_loaders
+from api.notification_handlers import handle_community_notifications
 from api.notifications import send_new_round_notification
 from api.resolvers.flags import Flags
 from api.resolvers.permissions import Permissions
@@ -13,6 +20,89 @@ from api.time import time
 
 logger = logging.getLogger("api.communities")
 
+# first key of the advisory locks taken by round_transition_lock, the
+# second one is the community id.
+ROUND_TRANSITION_LOCK = 1
+
+
+def permission_change(perm, mode, in_role, patch):
+    """
+    Returns (patch, response) once perm is granted or revoked (mode): the
+    mode of the permissions row of perm, or None if there should be none,
+    and the response of Community.handle_permission. patch is the mode of
+    that row beforehand, and in_role whether the roles give perm.
+    """
+    if mode == "grant":
+        if patch == "grant" or (in_role and patch != "revoke"):
+            response = f"Already had perm to {perm}."
+        elif in_role:
+            response = "granted."
+        else:
+            response = "granted"
+        return (None if in_role else "grant"), response
+
+    if patch == "grant" and not in_role:
+        response = "revoked."
+    elif not in_role or patch == "revoke":
+        response = f"Already not allowed to {perm}."
+    else:
+        response = "revoked"
+    return ("revoke" if in_role or patch is not None else None), response
+
+
+def _first_time(changed, key, done, already):
+    # a persona listed twice is only changed the first time.
+    if key in changed:
+        changed.discard(key)
+        return done
+    return already
+
+
+@contextmanager
+def round_transition_lock(context, community_id, wait=True):
+    """
+    Holds the Postgres advisory lock serializing the round transitions of
+    community_id across API instances and workers. Yields whether it was
+    acquired, which is always the case unless wait=False.
+
+    The lock is held by the connection rather than the transaction
+    (pg_advisory_xact_lock), since transitions commit several times.
+    Locks are reentrant, a connection holding one can take it again.
+
+    The locked section runs in a savepoint. It is committed before the
+    lock is released, so the next holder sees the transition, and only it
+    is rolled back if it raises.
+    """
+    conn = context["db-conn"]
+    key = (ROUND_TRANSITION_LOCK, community_id)
+    if wait:
+        conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_lock(*key)))
+        locked = True
+    else:
+        stmt = sqlalchemy.select(sqlalchemy.func.pg_try_advisory_lock(*key))
+        locked = conn.execute(stmt).scalar()
+    if not locked:
+        yield locked
+        return
+
+    savepoint = conn.begin_nested()
+    try:
+        yield locked
+    except Exception:
+        # an aborted transaction would fail the unlock, leaking the lock.
+        if savepoint.is_active:
+            savepoint.rollback()
+        else:
+            # the section committed, what is left uncommitted is its own.
+            conn.rollback()
+        raise
+    else:
+        if savepoint.is_active:
+            savepoint.commit()
+        conn.commit()
+    finally:
+        conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(*key)))
+
 
 class Communities:
     def __init__(
@@ -78,24 +168,79 @@ class Communities:
         """
         This method returs a Community.
         """
+        loaders = get_loaders(context)
+        identity_map = loaders.identity_map
         if id is not None:
-            stmt = sqlalchemy.select(db.models.communities).where(
-                db.models.communities.c.id == id
-            )
+            community = identity_map.get("communities", id)
+            if community is not None:
+                return community
+            fetched_community = loaders.communities.load(id)
         elif bridge_id is not None:
             stmt = sqlalchemy.select(db.models.communities).where(
                 db.models.communities.c.bridge_id == bridge_id
             )
-        fetched_community = context["db-conn"].execute(stmt).fetchone()
+            fetched_community = context["db-conn"].execute(stmt).fetchone()
+            if fetched_community is not None:
+                fetched_community = fetched_community._asdict()
+                community = identity_map.get("communities", fetched_community["id"])
+                if community is not None:
+                    return community
+                loaders.communities.prime(fetched_community)
         if fetched_community is None:
             raise None  # Exception(f"Community.id {id} doesn't exist")
 
-        if fetched_community.bridge_id is not None:
-            from api.bridged_round.resolvers import BridgedCommunity
+        def build(fields):
+            if fields["bridge_id"] is not None:
+                from api.bridged_round.resolvers import BridgedCommunity
+
+                return BridgedCommunity(context, fields)
+            return Community(context, fields)
+
+        return identity_map.get_or_build("communities", fetched_community, build)
 
-            return BridgedCommunity(context, fetched_community._asdict())
+    @classmethod
+    def needing_round_transition(_, context, community_ids=None):
+        """
+        Returns the communities the round worker has work for, found with a
+        single query: those whose active round is past its completion_time
+        and hasn't sent its closed notification, and those with no active
+        round but an eligible prompt. Only community_ids are checked if given.
+        """
+        now = time.utcnow()
+        communities = db.models.communities
+        rounds = db.models.rounds
+        prompts = db.models.prompts
+        posts = db.models.posts
 
-        return Community(context, fetched_community._asdict())
+        active_round = and_(
+            rounds.c.community_id == communities.c.id,
+            rounds.c.start_time <= now,
+            rounds.c.end_time > now,
+        )
+        closing = sqlalchemy.exists().where(
+            active_round,
+            rounds.c.completion_time <= now,
+            rounds.c.completion_notif_sent.isnot(True),
+        )
+        has_eligible_prompt = sqlalchemy.exists().where(
+            prompts.c.post_id == posts.c.id,
+            posts.c.community_id == communities.c.id,
+            prompts.c.status == "eligible",
+        )
+        stmt = (
+            sqlalchemy.select(communities)
+            .where(
+                sqlalchemy.or_(
+                    closing,
+                    and_(~sqlalchemy.exists().where(active_round), has_eligible_prompt),
+                )
+            )
+            .order_by(communities.c.id)
+        )
+        if community_ids is not None:
+            stmt = stmt.where(communities.c.id.in_(community_ids))
+        conn = context["db-conn"]
+        return [Community(context, c._asdict()) for c in conn.execute(stmt)]
 
     @classmethod
     def create(_, context, **kargs):
@@ -123,7 +268,9 @@ class Communities:
             .values(**values)
         )
         conn.execute(stmt)
+        invalidate(conn, "communities", id)
         conn.commit()
+        get_loaders(context).clear("communities", id)
         return Communities.get(context, id)
 
 
@@ -133,11 +280,23 @@ class Community:
         self._fields = fields
         for k, v in fields.items():
             setattr(self, k, v)
-        self._update_flags_attr()
+        get_loaders(context).community_flags.queue(self.id)
 
     def __str__(self):
         return str(self._fields)
 
+    def __getattr__(self, name):
+        # NOTE: only development_flags are available as attrs, e.g.
+        # community._FLAG_enabled_mod_actions.
+        if name.startswith("_FLAG_"):
+            label = name[len("_FLAG_") :]
+            for long_name, short_name in Flags.development_flags.items():
+                if label in (long_name, short_name):
+                    return long_name in self.flags
+        raise AttributeError(
+            f"{type(self).__name__!r} object has no attribute {name!r}"
+        )
+
     @property
     def is_bridge(self):
         return self.bridge_id is not None
@@ -180,6 +339,27 @@ class Community:
         ]
         return objs
 
+    @property
+    def member_community_ids(self):
+        """Ids of the communities whose members are the members of this one."""
+        return [self.id]
+
+    def members_connection(self, info=None, first=DEFAULT_FIRST, after=None):
+        personas = db.models.personas
+        memberships = db.models.memberships
+        member_ids = sqlalchemy.select(memberships.c.persona_id).where(
+            memberships.c.community_id.in_(self.member_community_ids)
+        )
+        stmt = sqlalchemy.select(personas).where(personas.c.id.in_(member_ids))
+        return Connection(
+            self._context,
+            stmt,
+            personas.c.id,
+            lambda fields: api.resolvers.personas.Persona(self._context, fields),
+            first,
+            after,
+        ).plan(info, "Persona")
+
     @property
     def posts(self):
         conn = self._context["db-conn"]
@@ -205,18 +385,11 @@ class Community:
         stmt = sqlalchemy.select(db.models.rounds).where(
             db.models.rounds.c.community_id == self.id
         )
-        objs = [
-            api.resolvers.rounds.Round(self._context, p._asdict())
-            for p in conn.execute(stmt)
-        ]
-        return objs
+        return api.resolvers.Rounds.from_rows(self._context, conn.execute(stmt))
 
-    @property
+    @cached_property
     def flags(self):
-        conn = self._context["db-conn"]
-        flags = db.models.community_flags
-        stmt = sqlalchemy.select(flags).where(flags.c.community_id == self.id)
-        flags = conn.execute(stmt).mappings().all()
+        flags = get_loaders(self._context).community_flags.load(self.id)
         labels = [row["label"] for row in flags]
         community_flags = list(set(list(Flags.basal_flags) + labels))
         return community_flags
@@ -233,7 +406,10 @@ class Community:
             }
         )
         self._context["db-conn"].execute(stmt)
+        invalidate(self._context["db-conn"], "community_flags", self.id)
         self._context["db-conn"].commit()
+        get_loaders(self._context).community_flags.clear(self.id)
+        self.__dict__.pop("flags", None)
         return True
 
     def remove_flag(self, label):
@@ -242,17 +418,12 @@ class Community:
             (flags.c.community_id == self.id) & (flags.c.label == label)
         )
         self._context["db-conn"].execute(stmt)
+        invalidate(self._context["db-conn"], "community_flags", self.id)
         self._context["db-conn"].commit()
+        get_loaders(self._context).community_flags.clear(self.id)
+        self.__dict__.pop("flags", None)
         return True
 
-    def _update_flags_attr(self):
-        # NOTE: only setting development_flags as attr
-        _flags = self.flags
-        for dev_flag in Flags.development_flags.items():
-            long_name, short_name = dev_flag
-            setattr(self, f"_FLAG_{long_name}", long_name in _flags)
-            setattr(self, f"_FLAG_{short_name}", long_name in _flags)
-
     @property
     def active_prompt(self):
         active_round = self.active_round
@@ -268,10 +439,7 @@ class Community:
             .where(db.models.rounds.c.start_time <= now)
             .where(db.models.rounds.c.end_time > now)
         )
-        objs = [
-            api.resolvers.rounds.Round(self._context, p._asdict())
-            for p in conn.execute(stmt)
-        ]
+        objs = api.resolvers.Rounds.from_rows(self._context, conn.execute(stmt))
         assert len(objs) <= 1, "each community must have at most 1 active round"
         return objs
 
@@ -401,9 +569,13 @@ class Community:
         """
         Closes currently active round and sets a new round.
 
-        Warning: this should remain an atomic method.
+        Warning: this should remain an atomic method. Concurrent calls for
+        a community are serialized by round_transition_lock.
         """
+        with round_transition_lock(self._context, self.id):
+            return self._move_to_next_round(force, method, printfn, duration)
 
+    def _move_to_next_round(self, force, method, printfn, duration):
         printfn(f"Community.id {self.id} calling move_to_next_round")
         methods = {
             "lowest_priority": api.resolvers.prompts.get_lowest_priority_prompt,
@@ -459,149 +631,211 @@ class Community:
         return "None"
 
     def handle_role(self, persona, role, mode, cascade=True):
-        conn = self._context["db-conn"]
-        stmt = sqlalchemy.select(db.models.memberships).where(
-            (db.models.memberships.c.persona_id == persona.id)
-            & (db.models.memberships.c.community_id == self.id)
-        )
-        membership = conn.execute(stmt).fetchone()
+        response = self.handle_roles([persona], role, mode, cascade)[0]
+        self._context["db-conn"].commit()
+        return response
 
-        if membership is None:
-            return "Not part of community"
+    def handle_permission(self, persona, perm, mode):
+        response = self.handle_permissions([persona], perm, mode)[0]
+        self._context["db-conn"].commit()
+        return response
 
-        if mode == "add":
-            if role in persona.role_in_community(self):
-                return f"Already has role {role}."
-            stmt = sqlalchemy.insert(db.models.community_roles).values(
-                membership_id=membership.id,
-                role=role,
+    def handle_registrations(self, personas, mode):
+        """
+        Same as handle_registration for each of personas, with one statement
+        per table. Returns the response of each.
+        """
+        memberships = db.models.memberships
+        persona_ids = [persona.id for persona in personas]
+        if mode == "register":
+            values = [
+                {"persona_id": persona_id, "community_id": self.id}
+                for persona_id in dict.fromkeys(persona_ids)
+            ]
+            stmt = insert(memberships).values(values)
+            stmt = stmt.on_conflict_do_nothing(
+                index_elements=[memberships.c.persona_id, memberships.c.community_id]
             )
-            conn.execute(stmt)
-            conn.commit()
-            if cascade:
-                self.refresh_permissions(persona)
-            return "Added"
-
-        elif mode == "remove":
-            if role not in persona.role_in_community(self):
-                return f"Didn't have role {role}."
-            stmt = sqlalchemy.delete(db.models.community_roles).where(
-                (db.models.community_roles.c.role == role)
-                & (db.models.community_roles.c.membership_id == membership.id)
+            responses = ("registered", "already registered")
+        elif mode == "unregister":
+            stmt = sqlalchemy.delete(memberships).where(
+                memberships.c.community_id == self.id,
+                memberships.c.persona_id.in_(persona_ids),
             )
-            conn.execute(stmt)
-            conn.commit()
-            return "Removed"
-
-    def handle_permission(self, persona, perm, mode):
-        assert mode in ["grant", "revoke"], f"mode '{mode}' not allowed."
-        if perm not in Permissions.metadata["permissions"]:
-            return f"perm '{perm}' unknown perm type."
-
-        conn = self._context["db-conn"]
-        stmt = sqlalchemy.select(db.models.memberships).where(
-            (db.models.memberships.c.persona_id == persona.id)
-            & (db.models.memberships.c.community_id == self.id)
+            responses = ("unregistered", "already unregistered")
+        else:
+            return ["None"] * len(personas)
+
+        stmt = stmt.returning(memberships.c.persona_id)
+        changed = set(self._context["db-conn"].execute(stmt).scalars())
+        api.resolvers.Personas.invalidate_memberships(self._context, changed)
+        changed_personas = {p.id: p for p in personas if p.id in changed}
+        handle_community_notifications(
+            self._context, list(changed_personas.values()), self, mode
         )
-        membership = conn.execute(stmt).fetchone()
-        if membership is None:
-            return "Not part of community"
-
-        perm_status = persona.user_perm_status(self, perm)
-        in_role = perm_status["in_role"]
-        is_granted = perm_status["is_granted"]
-        is_revoked = perm_status["is_revoked"]
-
-        has_perm = is_granted or (in_role and not is_revoked)
-        doesnt_have_perm = not in_role or is_revoked
-        # assert (has_perm and not doesnt_have_perm) or (not has_perm and doesnt_have_perm)
-
-        where_perm = (
-            sqlalchemy.select(db.models.permissions.c.id)
-            .join(db.models.memberships)
+        return [_first_time(changed, persona.id, *responses) for persona in personas]
+
+    def _memberships_of(self, personas, perm=None):
+        """
+        Returns {persona_id: {"membership_id", "roles", "patch"}} for the
+        personas in this community, with one query: the roles listed in
+        community_roles and the mode of the permissions row of perm, if any.
+        """
+        mt = db.models.memberships
+        crt = db.models.community_roles
+        pt = db.models.permissions
+        stmt = (
+            sqlalchemy.select(mt.c.persona_id, mt.c.id, crt.c.role, pt.c.mode)
+            .select_from(mt)
+            .outerjoin(crt, crt.c.membership_id == mt.c.id)
+            .outerjoin(pt, and_(pt.c.membership_id == mt.c.id, pt.c.perm == perm))
             .where(
-                and_(
-                    db.models.memberships.c.id == membership.id,
-                    db.models.permissions.c.perm == perm,
-                )
+                mt.c.community_id == self.id,
+                mt.c.persona_id.in_([persona.id for persona in personas]),
             )
         )
+        memberships = {}
+        for persona_id, membership_id, role, mode in self._context["db-conn"].execute(
+            stmt
+        ):
+            membership = memberships.setdefault(
+                persona_id,
+                {"membership_id": membership_id, "roles": [], "patch": mode},
+            )
+            if role is not None:
+                membership["roles"].append(role)
+        return memberships
 
-        if is_granted and mode == "revoke" and not in_role:
+    def handle_roles(self, personas, role, mode, cascade=True):
+        """
+        Adds or removes role of each of personas, with one statement per
+        table, on the caller's transaction. With cascade, the patches
+        granting permissions of an added role are dropped. Returns the
+        response of each.
+        """
+        crt = db.models.community_roles
+        memberships = self._memberships_of(personas)
+        membership_ids = list(
+            dict.fromkeys(m["membership_id"] for m in memberships.values())
+        )
+        # roles every member has, see Persona.membership_permissions.
+        implicit = role in ["persona", "member"]
+        if mode not in ["add", "remove"]:
+            return [None] * len(personas)
+        responses = {
+            "add": ("Added", f"Already has role {role}."),
+            "remove": ("Removed", f"Didn't have role {role}."),
+        }[mode]
+
+        changed = set()
+        if mode == "add" and membership_ids and not implicit:
             stmt = (
-                sqlalchemy.update(db.models.permissions)
-                .where(db.models.permissions.c.id.in_(where_perm))
-                .values(mode=mode)
+                insert(crt)
+                .values([{"membership_id": id, "role": role} for id in membership_ids])
+                .on_conflict_do_nothing(
+                    index_elements=[crt.c.membership_id, crt.c.role]
+                )
+                .returning(crt.c.membership_id)
             )
-            conn.execute(stmt)
-            conn.commit()
-            return "revoked."
-
-        # if persona has been granted a new role, need to remove the singular patch
-        if in_role and (is_granted or (is_revoked and mode == "grant")):
-            stmt = sqlalchemy.delete(db.models.permissions).where(
-                db.models.permissions.c.id.in_(where_perm)
+            changed = set(self._context["db-conn"].execute(stmt).scalars())
+            if changed and cascade:
+                # patches granting what the role now gives are redundant.
+                masks = Permissions.masks()
+                pt = db.models.permissions
+                stmt = sqlalchemy.delete(pt).where(
+                    pt.c.membership_id.in_(changed),
+                    pt.c.mode == "grant",
+                    pt.c.perm.in_(masks.perms_of(masks.roles_mask([role]))),
+                )
+                self._context["db-conn"].execute(stmt)
+        elif mode == "remove" and membership_ids:
+            stmt = (
+                sqlalchemy.delete(crt)
+                .where(crt.c.role == role, crt.c.membership_id.in_(membership_ids))
+                .returning(crt.c.membership_id)
             )
-            conn.execute(stmt)
-            conn.commit()
-            if is_revoked and mode == "grant":
-                return "granted."
+            changed = set(self._context["db-conn"].execute(stmt).scalars())
+            if implicit:
+                changed = set(membership_ids)
 
-        if mode == "grant" and has_perm:
-            return f"Already had perm to {perm}."
+        api.resolvers.Personas.invalidate_memberships(
+            self._context,
+            [pid for pid, m in memberships.items() if m["membership_id"] in changed],
+        )
+        results = []
+        for persona in personas:
+            membership = memberships.get(persona.id)
+            if membership is None:
+                results.append("Not part of community")
+            else:
+                results.append(
+                    _first_time(changed, membership["membership_id"], *responses)
+                )
+        return results
 
-        if mode == "revoke" and doesnt_have_perm:
-            return f"Already not allowed to {perm}."
+    def handle_permissions(self, personas, perm, mode):
+        """
+        Grants or revokes perm to each of personas, on the caller's
+        transaction: their patches are upserted, or deleted when their roles
+        already decide, see permission_change. Returns the response of each.
+        """
+        assert mode in ["grant", "revoke"], f"mode '{mode}' not allowed."
+        masks = Permissions.masks()
+        if perm not in masks.bits:
+            return [f"perm '{perm}' unknown perm type."] * len(personas)
+
+        pt = db.models.permissions
+        memberships = self._memberships_of(personas, perm)
+        responses, repeats, upserts, deletes = {}, {}, {}, []
+        for persona_id, membership in memberships.items():
+            roles = ["persona", "member"] + membership["roles"]
+            in_role = masks.has(masks.roles_mask(roles), perm)
+            patch, responses[persona_id] = permission_change(
+                perm, mode, in_role, membership["patch"]
+            )
+            # the response to a persona listed again, once changed.
+            _, repeats[persona_id] = permission_change(perm, mode, in_role, patch)
+            if patch == membership["patch"]:
+                continue
+            if patch is None:
+                deletes.append(membership["membership_id"])
+            else:
+                upserts[membership["membership_id"]] = patch
 
-        if (is_revoked and mode == "grant") or (is_granted and mode == "revoke"):
-            stmt = (
-                sqlalchemy.update(db.models.permissions)
-                .where(db.models.permissions.c.id.in_(where_perm))
-                .values(mode=mode)
+        conn = self._context["db-conn"]
+        if upserts:
+            values = [
+                {"membership_id": id, "perm": perm, "mode": patch}
+                for id, patch in upserts.items()
+            ]
+            stmt = insert(pt).values(values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[pt.c.membership_id, pt.c.perm],
+                set_={"mode": stmt.excluded.mode},
             )
             conn.execute(stmt)
-            conn.commit()
-
-        if (in_role and mode == "revoke") or (
-            not in_role and mode == "grant" and not is_revoked
-        ):
-            stmt = sqlalchemy.insert(db.models.permissions).values(
-                membership_id=membership.id, perm=perm, mode=mode
+        if deletes:
+            stmt = sqlalchemy.delete(pt).where(
+                pt.c.membership_id.in_(deletes), pt.c.perm == perm
             )
             conn.execute(stmt)
-            conn.commit()
-
-        return {"grant": "granted", "revoke": "revoked"}[mode]
-
-    def refresh_permissions(self, persona):
-        # remove patches of granted permissions that are in new role.
-        basal_role_perms = persona.user_perm_basal(self)
-        patch_perms = persona.user_perm_patches(self)
-
-        conn = self._context["db-conn"]
-        stmt = sqlalchemy.select(db.models.memberships).where(
-            (db.models.memberships.c.persona_id == persona.id)
-            & (db.models.memberships.c.community_id == self.id)
+        changed = set(upserts) | set(deletes)
+        api.resolvers.Personas.invalidate_memberships(
+            self._context,
+            [pid for pid, m in memberships.items() if m["membership_id"] in changed],
         )
-        membership = conn.execute(stmt).fetchone()
-
-        for perm in basal_role_perms["permissions"]:
-            if perm in patch_perms["grant"]:
-                where_perm = (
-                    sqlalchemy.select(db.models.permissions.c.id)
-                    .join(db.models.memberships)
-                    .where(
-                        and_(
-                            db.models.memberships.c.id == membership.id,
-                            db.models.permissions.c.perm == perm,
-                        )
+        results = []
+        first = set(memberships)
+        for persona in personas:
+            if persona.id not in memberships:
+                results.append("Not part of community")
+            else:
+                results.append(
+                    _first_time(
+                        first, persona.id, responses[persona.id], repeats[persona.id]
                     )
                 )
-                stmt = sqlalchemy.delete(db.models.permissions).where(
-                    db.models.permissions.c.id.in_(where_perm)
-                )
-                conn.execute(stmt)
-                conn.commit()
+        return results
 
     def get_personas_id_by_role(self, role):
         session = self._context["session"]
@@ -1,6 +1,7 @@
 import sqlalchemy
 import db.models as models
 from api.assets import ImageBucket
+from api.loaders import get_loaders
 from api.time import time
 
 import logging
@@ -52,12 +53,11 @@ class Images:
         """
         This method returs an Image.
         """
-        stmt = sqlalchemy.select(models.images).where(models.images.c.id == id)
-        fetched_image = context["db-conn"].execute(stmt).fetchone()
+        fetched_image = get_loaders(context).images.load(id)
         if fetched_image is None:
             raise Exception(f"Image.id {id} doesn't exist")
 
-        return Image(context, fetched_image._asdict(), w, h)
+        return Image(context, fetched_image, w, h)
 
 
 class Image:
@@ -37,6 +37,12 @@ class Permissions:
     persona.user_permissions(community)
         # returns list of permissions, where permission patches in `patch_perms`
         # are APPLIED TO `basal_role_perms`
+
+    The roles -> groups -> permissions closure is compiled into PermissionMasks,
+    integers with one bit per entry in metadata['permissions'], so that roles
+    and patches combine with bit operations. Permissions.masks() recompiles it
+    when metadata changed through set_role, set_group or add_permission, or
+    when permissions were appended directly.
     """
 
     metadata = {
@@ -177,6 +183,29 @@ class Permissions:
                     ), f"{perm} not in 'permissions'."
             if verbose:
                 print("========================================================")
+        Permissions.compile()
+
+    _masks = None
+    _version = 0
+
+    @staticmethod
+    def compile():
+        Permissions._version += 1
+        Permissions._masks = PermissionMasks(Permissions.metadata)
+        Permissions._masks.version = Permissions._version
+        return Permissions._masks
+
+    @staticmethod
+    def masks():
+        """Returns the compiled PermissionMasks of metadata."""
+        masks = Permissions._masks
+        if (
+            masks is None
+            or masks.version != Permissions._version
+            or masks.size != len(Permissions.metadata["permissions"])
+        ):
+            masks = Permissions.compile()
+        return masks
 
     @staticmethod
     def set_role(name, groups=None):
@@ -184,6 +213,7 @@ class Permissions:
         if groups is None:
             groups = []
         metadata["roles"][name] = groups
+        Permissions._version += 1
 
     @staticmethod
     def set_group(name, permissions=None):
@@ -191,11 +221,65 @@ class Permissions:
         if permissions is None:
             permissions = []
         metadata["groups"][name] = permissions
+        Permissions._version += 1
 
     @staticmethod
     def add_permission(name):
         metadata = Permissions.metadata
         metadata["permissions"].append(name)
+        Permissions._version += 1
+
+
+class PermissionMasks:
+    """
+    Permissions.metadata compiled into bitmasks, one bit per permission.
+
+    masks.roles_mask(["member"])        # permissions of the roles
+    masks.mask_of(["community.edit"])   # bits of the listed permissions
+    masks.perms_of(mask)                # permission names of the bits in mask
+    """
+
+    def __init__(self, metadata):
+        self.version = None
+        self.size = len(metadata["permissions"])
+        self.bits = {}
+        for perm in metadata["permissions"]:
+            self.bits.setdefault(perm, 1 << len(self.bits))
+        self.groups = {
+            group: self.mask_of(perms) for group, perms in metadata["groups"].items()
+        }
+        self.roles = {}
+        for role, groups in metadata["roles"].items():
+            mask = 0
+            for group in groups:
+                mask |= self.groups.get(group, 0)
+            self.roles[role] = mask
+        self._perms = {}
+
+    def roles_mask(self, roles):
+        mask = 0
+        for role in roles:
+            mask |= self.roles.get(role, 0)
+        return mask
+
+    def mask_of(self, perms):
+        """Unknown permissions have no bit and are left out."""
+        mask = 0
+        for perm in perms:
+            mask |= self.bits.get(perm, 0)
+        return mask
+
+    def perms_of(self, mask):
+        # few distinct masks are ever built (one per role combination and
+        # patch set), so their expansion is kept.
+        if mask not in self._perms:
+            if len(self._perms) >= 4096:
+                self._perms.clear()
+            self._perms[mask] = [perm for perm, bit in self.bits.items() if mask & bit]
+        return list(self._perms[mask])
+
+    def has(self, mask, perm):
+        return bool(mask & self.bits.get(perm, 0))
 
 
 if __name__ == "__main__":
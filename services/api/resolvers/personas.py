@@ -1,13 +1,20 @@
 import logging
+import os
 import random
+from functools import cached_property
 
 import db.models
 import sqlalchemy
-from sqlalchemy import and_, delete, insert, select, update
+from sqlalchemy import and_, delete, select, update
+from sqlalchemy.dialects.postgresql import insert
 
 import api.resolvers
+from api import cache
+from api.cache import TTLCache, invalidate_many
+from api.connections import DEFAULT_FIRST, Connection
 from api.content_mod import moderation_required
 from api.exceptions import UnauthorizedError
+from api.loaders import get_loaders
 from api.notification_handlers import handle_community_notification
 from api.resolvers import Communities
 from api.resolvers.permissions import Permissions
@@ -15,6 +22,13 @@ from api.resolvers.siwf_accounts import SIWFAccounts
 
 logger = logging.getLogger("api.personas")
 
+# persona_id -> {community_id: roles and permission patches}, the app reads
+# them on every community screen. Invalidated by invalidate_memberships.
+PERMISSION_CACHE_TTL = int(os.environ.get("PERMISSION_CACHE_TTL", 5 * 60))
+_memberships = cache.register(
+    "memberships", TTLCache(maxsize=10000, ttl=PERMISSION_CACHE_TTL)
+)
+
 
 class Personas:
     def __init__(self, context, start, limit, pkh):
@@ -37,17 +51,35 @@ class Personas:
     def get(context, persona_id=None, pkh=None):
         """Returns a Persona object for the requested persona id."""
 
-        stmt = sqlalchemy.select(db.models.personas)
+        loaders = get_loaders(context)
         if pkh is None:
-            stmt = stmt.where(db.models.personas.c.id == persona_id)
+            persona = loaders.identity_map.get("personas", persona_id)
+            if persona is not None:
+                return persona
+            fields = loaders.personas.load(persona_id)
         else:
-            stmt = stmt.where(db.models.personas.c.pkh == pkh)
+            fields = loaders.personas_by_pkh.load(pkh)
 
-        conn = context["db-conn"]
-        fetched_persona = conn.execute(stmt).fetchone()
-        if fetched_persona is None:
+        if fields is None:
             return None
-        return Persona(context, fetched_persona._asdict())
+        return loaders.identity_map.get_or_build(
+            "personas", fields, lambda fields: Persona(context, fields)
+        )
+
+    @staticmethod
+    def get_many(context, pkhs):
+        """Returns the Persona of each of pkhs, or None, with one query."""
+        get_loaders(context).personas_by_pkh.queue(*pkhs)
+        return [Personas.get(context, pkh=pkh) for pkh in pkhs]
+
+    @staticmethod
+    def invalidate_memberships(context, persona_ids):
+        """Same as Persona.invalidate_memberships for each of persona_ids."""
+        persona_ids = set(persona_ids)
+        invalidate_many(context["db-conn"], "memberships", persona_ids)
+        request_cache = get_loaders(context).memberships
+        for key in [key for key in request_cache if key[0] in persona_ids]:
+            del request_cache[key]
 
     @classmethod
     def update_profile_pic(_, context, pkh, image_id):
@@ -60,9 +92,11 @@ class Personas:
             update(db.models.personas)
             .where(db.models.personas.c.pkh == pkh)
             .values(image_id=image_id)
+            .returning(db.models.personas.c.id)
         )
-        conn.execute(stmt)
+        persona_id = conn.execute(stmt).scalar()
         conn.commit()
+        get_loaders(context).clear("personas", persona_id)
         logger.info("Updating profile picture to id %s", image_id)
         return Personas.get(context, pkh=pkh)
 
@@ -77,9 +111,11 @@ class Personas:
             update(db.models.personas)
             .where(db.models.personas.c.pkh == pkh)
             .values(image_id=None)
+            .returning(db.models.personas.c.id)
         )
-        conn.execute(stmt)
+        persona_id = conn.execute(stmt).scalar()
         conn.commit()
+        get_loaders(context).clear("personas", persona_id)
         logger.info("Removing profile picture to user.")
         return Personas.get(context, pkh=pkh)
 
@@ -104,6 +140,7 @@ class Personas:
         )
         conn.execute(stmt)
         conn.commit()
+        get_loaders(context).clear("prompts", prompt_id)
         logger.info("Removing prompt to user.")
         prompt = api.resolvers.prompts.Prompts.get(context, prompt_id)
         return prompt
@@ -115,11 +152,17 @@ class Persona:
         self._fields = fields
         for k, v in fields.items():
             setattr(self, k, v)
-        self.msa_handle = SIWFAccounts.get_msa_handle_for_persona(context, self.id)
+        loaders = get_loaders(context)
+        loaders.frequency_metadata.queue(self.id)
+        loaders.images.queue(fields.get("image_id"))
 
     def __str__(self):
         return str(self._fields)
 
+    @cached_property
+    def msa_handle(self):
+        return SIWFAccounts.get_msa_handle_for_persona(self._context, self.id)
+
     @property
     def communities(self):
         conn = self._context["db-conn"]
@@ -162,7 +205,59 @@ class Persona:
         prompts = [post.prompt for post in self.posts if post.is_prompt]
         return prompts
 
-    @property
+    def communities_connection(self, info=None, first=DEFAULT_FIRST, after=None):
+        communities = db.models.communities
+        memberships = db.models.memberships
+        community_ids = sqlalchemy.select(memberships.c.community_id).where(
+            memberships.c.persona_id == self.id
+        )
+        stmt = sqlalchemy.select(communities).where(communities.c.id.in_(community_ids))
+        return Connection(
+            self._context,
+            stmt,
+            communities.c.id,
+            lambda fields: api.resolvers.communities.Community(self._context, fields),
+            first,
+            after,
+        ).plan(info, "Community")
+
+    def posts_connection(self, info=None, first=DEFAULT_FIRST, after=None):
+        posts = db.models.posts
+        stmt = sqlalchemy.select(posts).where(
+            posts.c.author_id == self.id,
+            posts.c.mod_removed != True,  # noqa: E712
+        )
+        return Connection(
+            self._context,
+            stmt,
+            posts.c.id,
+            lambda fields: api.resolvers.posts.Post(self._context, fields),
+            first,
+            after,
+        ).plan(info, "Post")
+
+    def prompts_connection(self, info=None, first=DEFAULT_FIRST, after=None):
+        posts = db.models.posts
+        prompts = db.models.prompts
+        stmt = (
+            sqlalchemy.select(prompts)
+            .join(posts, posts.c.id == prompts.c.post_id)
+            .where(
+                posts.c.author_id == self.id,
+                posts.c.in_reply_to.is_(None),
+                posts.c.mod_removed != True,  # noqa: E712
+            )
+        )
+        return Connection(
+            self._context,
+            stmt,
+            prompts.c.id,
+            lambda fields: api.resolvers.prompts.Prompt(self._context, fields),
+            first,
+            after,
+        ).plan(info, "Prompt")
+
+    @cached_property
     def image(self):
         image = api.resolvers.Images.get(self._context, self.image_id)
         return image
@@ -200,78 +295,58 @@ class Persona:
         return round.allows_playing_by(self)
 
     def is_in_community(self, community):
-        conn = self._context["db-conn"]
-
-        community_ids = [community.id]
-        if community.is_bridge:
-            community_ids = community.bridge_ids
-
-        stmt = select(db.models.memberships).where(
-            (db.models.memberships.c.persona_id == self.id)
-            & (db.models.memberships.c.community_id.in_(community_ids))
-        )
-        if conn.execute(stmt).fetchone():
-            return True
-        return False
+        # roles always include "member" for personas in community.
+        return "member" in self.membership_permissions(community)["roles"]
 
     def join_community(self, community):
-        if self.is_in_community(community):
-            return "already registered"
-
-        stmt = insert(db.models.memberships).values(
-            {
-                "persona_id": self.id,
-                "community_id": community.id,
-            }
+        memberships = db.models.memberships
+        stmt = (
+            insert(memberships)
+            .values(persona_id=self.id, community_id=community.id)
+            .on_conflict_do_nothing(
+                index_elements=[memberships.c.persona_id, memberships.c.community_id]
+            )
+            .returning(memberships.c.id)
         )
-        self._context["db-conn"].execute(stmt)
+        if self._context["db-conn"].execute(stmt).first() is None:
+            return "already registered"
+        self.invalidate_memberships()
         handle_community_notification(self, community, "register")
         return "registered"
 
     def leave_community(self, community):
-        if self.is_in_community(community):
-            stmt = delete(db.models.memberships).where(
-                (db.models.memberships.c.persona_id == self.id)
-                & (db.models.memberships.c.community_id == community.id)
+        memberships = db.models.memberships
+        stmt = (
+            delete(memberships)
+            .where(
+                (memberships.c.persona_id == self.id)
+                & (memberships.c.community_id == community.id)
             )
-            self._context["db-conn"].execute(stmt)
-            handle_community_notification(self, community, "unregister")
-            return "unregistered"
-        return "already unregistered"
-
-    def user_permissions(self, community):
-        # get permissions for each role in community_roles as populaed in permissions.py
-        basal_role_perms = self.user_perm_basal(community)
-
-        # get permissions patched in table permissions
-        patch_perms = self.user_perm_patches(community)
-
-        # update with added permissions
-        basal_role_perms["permissions"] = list(
-            set(basal_role_perms["permissions"] + patch_perms["grant"])
-        )
-
-        # update with removed permissions
-        basal_role_perms["permissions"] = list(
-            set(basal_role_perms["permissions"]) - set(patch_perms["revoke"])
+            .returning(memberships.c.id)
         )
+        if self._context["db-conn"].execute(stmt).first() is None:
+            return "already unregistered"
+        self.invalidate_memberships()
+        handle_community_notification(self, community, "unregister")
+        return "unregistered"
 
-        return basal_role_perms
+    def user_permissions(self, community):
+        # role permissions, as compiled in permissions.py, with the patches
+        # of table permissions applied: granted ones added, revoked ones removed.
+        masks = Permissions.masks()
+        membership = self.membership_permissions(community)
+        response = self.user_perm_basal(community, membership)
+        mask = (membership["role_mask"] | membership["grant"]) & ~membership["revoke"]
+        response["permissions"] = masks.perms_of(mask)
+        return response
 
     def user_perm_patches(self, community):
-        session = self._context["session"]
-        pt = db.models.permissions
-        mt = db.models.memberships
-        perms = (
-            session.query(pt.c.perm, pt.c.mode)
-            .join(mt)
-            .filter(and_(mt.c.persona_id == self.id, mt.c.community_id == community.id))
-            .all()
-        )
-        patch_perms = {"grant": [], "revoke": []}
-        for perm, mode in perms:
-            patch_perms[mode].append(perm)
-        return patch_perms
+        masks = Permissions.masks()
+        membership = self.membership_permissions(community)
+        return {
+            "grant": masks.perms_of(membership["grant"]),
+            "revoke": masks.perms_of(membership["revoke"]),
+        }
 
     def user_perm_grant(self, community, perm):
         return community.handle_permission(self, perm, "grant")
@@ -279,32 +354,32 @@ class Persona:
     def user_perm_revoke(self, community, perm):
         return community.handle_permission(self, perm, "revoke")
 
-    def user_perm_status(self, community, perm):
-        basal_role_perms = self.user_perm_basal(community)
-        patch_perms = self.user_perm_patches(community)
+    def user_perm_status(self, community, perm, membership=None):
+        masks = Permissions.masks()
+        if membership is None:
+            membership = self.membership_permissions(community)
         response = {
-            "in_role": perm in basal_role_perms["permissions"],
-            "is_granted": perm in patch_perms["grant"],
-            "is_revoked": perm in patch_perms["revoke"],
+            "in_role": masks.has(membership["role_mask"], perm),
+            "is_granted": masks.has(membership["grant"], perm),
+            "is_revoked": masks.has(membership["revoke"], perm),
         }
         return response
 
-    def user_perm_basal(self, community):
+    def user_perm_basal(self, community, membership=None):
         response = {"roles": [], "groups": [], "permissions": []}
         perm_base = Permissions.metadata
+        masks = Permissions.masks()
 
         if community is not None:
-            response["roles"] = self.role_in_community(community)
+            if membership is None:
+                membership = self.membership_permissions(community)
+            response["roles"] = membership["roles"]
         else:
             response["roles"] = ["persona"]
 
         for role in response["roles"]:
-            role_groups = perm_base["roles"].get(role, [])
-            response["groups"] += list(role_groups)
-
-            for group in role_groups:
-                group_perms = perm_base["groups"].get(group, [])
-                response["permissions"] += list(group_perms)
+            response["groups"] += list(perm_base["roles"].get(role, []))
+        response["permissions"] = masks.perms_of(masks.roles_mask(response["roles"]))
 
         return response
 
@@ -313,32 +388,116 @@ class Persona:
         return self.user_perm_basal(None)
 
     def role_in_community(self, community):
-        # everyone is a member since role_in_community is associated to membership;
-        self._context["db-conn"]
-        session = self._context["session"]
+        return self.membership_permissions(community)["roles"]
+
+    def membership_permissions(self, community):
+        """
+        Returns the roles of persona in community and its permission patches:
+
+        {
+            "membership_id": id of the membership in community, or None,
+            "roles": role names, as returned by role_in_community,
+            "role_mask": permissions of those roles,
+            "grant": permissions granted by patches,
+            "revoke": permissions revoked by patches,
+        }
+
+        They are loaded with one query, and cached in the request and in
+        the process until invalidate_memberships is called.
+        """
+        masks = Permissions.masks()
+        membership = self._load_membership(community)
+        return {
+            "membership_id": membership["membership_id"],
+            "roles": list(membership["roles"]),
+            "role_mask": masks.roles_mask(membership["roles"]),
+            "grant": masks.mask_of(membership["grant"]),
+            "revoke": masks.mask_of(membership["revoke"]),
+        }
+
+    def invalidate_memberships(self):
+        """Drops the cached roles and permissions of persona, in every
+        community. Must be called before committing any change to its
+        memberships, community_roles or permissions."""
+        Personas.invalidate_memberships(self._context, [self.id])
+
+    def _load_membership(self, community):
+        request_cache = get_loaders(self._context).memberships
+        key = (self.id, community.id)
+        if key in request_cache:
+            return request_cache[key]
+
+        # memberships changed by this transaction aren't cached by the
+        # process until committed, see api.cache.invalidated.
+        conn = self._context["db-conn"]
+        if cache.invalidated(conn, "memberships", self.id):
+            membership = self._query_membership(community)
+        else:
+            membership = _memberships.get(self.id, {}).get(community.id)
+            if membership is None:
+                membership = self._query_membership(community)
+                communities = dict(_memberships.get(self.id, {}))
+                communities[community.id] = membership
+                _memberships.set(self.id, communities)
+        request_cache[key] = membership
+        return membership
+
+    def _query_membership(self, community):
+        conn = self._context["db-conn"]
 
         crt = db.models.community_roles
         mt = db.models.memberships
+        pt = db.models.permissions
 
+        # everyone is a member since role_in_community is associated to membership;
         community_ids = [community.id]
         if community.is_bridge:
             community_ids = community.bridge_ids
 
         roles = (
-            session.query(crt.c.role)
-            .join(mt)
-            .filter(
+            select(
+                mt.c.id,
+                mt.c.community_id,
+                crt.c.role,
+                sqlalchemy.null().label("perm"),
+                sqlalchemy.null().label("mode"),
+            )
+            .select_from(mt.outerjoin(crt))
+            .where(
                 and_(mt.c.persona_id == self.id, mt.c.community_id.in_(community_ids))
             )
-            .all()
+        )
+        patches = (
+            select(
+                mt.c.id,
+                mt.c.community_id,
+                sqlalchemy.null(),
+                pt.c.perm,
+                pt.c.mode,
+            )
+            .select_from(mt.join(pt))
+            .where(and_(mt.c.persona_id == self.id, mt.c.community_id == community.id))
         )
 
-        if len(roles) == 0 and self.is_in_community(community):
-            return ["persona", "member"]
-        elif len(roles) == 0:
-            return ["persona"]
-        roles = ["persona", "member"] + [r.role for r in roles]
-        return list(set(roles))
+        in_community = False
+        membership = {"membership_id": None, "grant": [], "revoke": []}
+        role_names = []
+        for row in conn.execute(roles.union_all(patches)):
+            in_community = True
+            if row.community_id == community.id:
+                membership["membership_id"] = row.id
+            if row.role is not None:
+                role_names.append(row.role)
+            if row.perm is not None:
+                membership[row.mode].append(row.perm)
+
+        if len(role_names) == 0 and in_community:
+            membership["roles"] = ["persona", "member"]
+        elif len(role_names) == 0:
+            membership["roles"] = ["persona"]
+        else:
+            membership["roles"] = list(set(["persona", "member"] + role_names))
+        return membership
 
     @moderation_required
     def run_ai_mod(
@@ -373,6 +532,9 @@ def create_persona(context, name, bio, pkh, assigned_id=None):
         stmt = insert(db.models.personas).values(**values)
         conn.execute(stmt)
         conn.commit()
+    loaders = get_loaders(context)
+    loaders.clear("personas", assigned_id)
+    loaders.personas_by_pkh.clear(pkh)
 
     return Persona(context, values)
 
@@ -395,4 +557,5 @@ def update_persona(context, pkh, name, bio):
 
     stmt = select(db.models.personas).where(db.models.personas.c.pkh == pkh)
     persona = conn.execute(stmt).fetchone()
-    return Persona(context, persona._asdict())
+    get_loaders(context).prime("personas", persona._asdict())
+    return Personas.get(context, persona_id=persona.id)
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+from functools import cached_property
 
 import db.models
 import sqlalchemy
@@ -8,14 +9,15 @@ from dotenv import load_dotenv
 from sqlalchemy import insert
 
 import api.resolvers
-from api.resolvers import Personas, Persona, Community, Communities
-from api.bridged_round.resolvers import BridgedCommunity
+from api.resolvers import Personas, Persona, Communities
 from api.assets import AudioBucket
 from api.content_mod import (
     assistant_checks_post,
     moderation_except,
     moderation_required,
 )
+from api.loaders import get_loaders
+from api.resolvers.prompts import refresh_reply_counts
 from api.time import time
 
 load_dotenv()
@@ -58,20 +60,24 @@ class Posts:
         """
         This method returs a Post.
         """
-        if id is not None:
-            stmt = sqlalchemy.select(db.models.posts).where(db.models.posts.c.id == id)
-        fetched_post = context["db-conn"].execute(stmt).fetchone()
+        loaders = get_loaders(context)
+        post = loaders.identity_map.get("posts", id)
+        if post is not None:
+            return post
+
+        fetched_post = loaders.posts.load(id)
         if fetched_post is None:
             raise Exception(f"Post.id {id} doesn't exist")
 
-        post = Post(context, fetched_post._asdict())
-
-        if post.community.is_bridge:
-            from api.bridged_round.resolvers.bridged_post import BridgedPost
+        def build(fields):
+            post = Post(context, fields)
+            if post.community.is_bridge:
+                from api.bridged_round.resolvers.bridged_post import BridgedPost
 
-            return BridgedPost(post._context, post._fields)
+                return BridgedPost(post._context, post._fields)
+            return post
 
-        return post
+        return loaders.identity_map.get_or_build("posts", fetched_post, build)
 
 
 class Post:
@@ -82,34 +88,39 @@ class Post:
         for k, v in fields.items():
             setattr(self, k, v)
         self._initializing = False
+        self._queue_relationships()
 
     def __str__(self):
         return str(self._fields)
 
-    @property
+    def _queue_relationships(self):
+        loaders = get_loaders(self._context)
+        loaders.personas.queue(self._fields.get("author_id"))
+        loaders.frequency_metadata.queue(self._fields.get("author_id"))
+        loaders.communities.queue(self._fields.get("community_id"))
+        loaders.audios.queue(self._fields.get("audio_id"))
+        in_reply_to = self._fields.get("in_reply_to")
+        if in_reply_to is None:
+            loaders.prompts_by_post.queue(self._fields.get("id"))
+        else:
+            loaders.posts.queue(in_reply_to)
+
+    @cached_property
     def community(self):
-        conn = self._context["db-conn"]
-        communities = db.models.communities
-        stmt = sqlalchemy.select(communities).where(
-            communities.c.id == self.community_id
-        )
-        result = conn.execute(stmt).fetchone()
-        if result.bridge_id is None:
-            return Community(self._context, result._asdict())
-        return BridgedCommunity(self._context, result._asdict())
+        return Communities.get(self._context, id=self.community_id)
 
-    @property
+    @cached_property
     def author(self):
         author = Personas.get(self._context, persona_id=self.author_id)
         return author
 
-    @property
+    @cached_property
     def prompt(self):
         if not self.is_prompt:
             return None
         return api.resolvers.Prompts.get(self._context, post_id=self.id)
 
-    @property
+    @cached_property
     def audio(self):
         audio = api.resolvers.Audios.get(self._context, self.audio_id)
         return audio
@@ -118,7 +129,7 @@ class Post:
     def is_prompt(self):
         return self.in_reply_to is None
 
-    @property
+    @cached_property
     def round(self):
         if self.is_prompt:
             return self.prompt.round
@@ -244,6 +255,7 @@ class Post:
                 )
                 conn.execute(stmt)
                 conn.commit()
+                get_loaders(self._context).clear("posts", self.id)
         self._fields["ai_mod_output"] = value
 
     @property
@@ -263,7 +275,10 @@ class Post:
                     .values(mod_removed=value)
                 )
                 conn.execute(stmt)
+                if self.in_reply_to is not None:
+                    refresh_reply_counts(self._context, [self.in_reply_to])
                 conn.commit()
+                get_loaders(self._context).clear("posts", self.id)
         self._fields["mod_removed"] = value
 
     @moderation_required
@@ -368,6 +383,9 @@ class Post:
         )
         conn.execute(stmt)
         conn.commit()
+        get_loaders(self._context).clear("posts", self.id)
+        self._fields["mod_metadata"] = metadata
+        self.mod_metadata = metadata
 
     @moderation_required
     def update_mod_cid_flag(self, cid, value):
@@ -400,6 +418,8 @@ def create_post(context, audio_id=None, **kwargs):
     result = conn.execute(stmt)
 
     new_post_id = result.inserted_primary_key[0]
+    if values["in_reply_to"] is not None:
+        refresh_reply_counts(context, [values["in_reply_to"]])
     conn.commit()
 
     logger.info(f"PROCESS_NEW_POST_IN_SERIES {PROCESS_NEW_POST_IN_SERIES}")
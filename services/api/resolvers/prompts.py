@@ -1,8 +1,12 @@
+from functools import cached_property
+
 import db.models as models
 import sqlalchemy
 from sqlalchemy import and_, insert
 
 import api.resolvers as resolvers
+from api.connections import Connection
+from api.loaders import get_loaders
 import logging
 
 logger = logging.getLogger("api.prompts")
@@ -28,16 +32,20 @@ class Prompts:
         """
         This method returs a Prompt.
         """
+        loaders = get_loaders(context)
+        fetched_prompt = None
         if id is not None:
-            stmt = sqlalchemy.select(models.prompts).where(models.prompts.c.id == id)
+            prompt = loaders.identity_map.get("prompts", id)
+            if prompt is not None:
+                return prompt
+            fetched_prompt = loaders.prompts.load(id)
         elif post_id:
-            stmt = sqlalchemy.select(models.prompts).where(
-                models.prompts.c.post_id == post_id
-            )
-        fetched_prompt = context["db-conn"].execute(stmt).fetchone()
+            fetched_prompt = loaders.prompts_by_post.load(post_id)
         if fetched_prompt is None:
             raise Exception(f"Prompt.id {id} or post_id {post_id} don't exist")
-        return Prompt(context, fetched_prompt._asdict())
+        return loaders.identity_map.get_or_build(
+            "prompts", fetched_prompt, lambda fields: Prompt(context, fields)
+        )
 
 
 class Prompt:
@@ -47,38 +55,32 @@ class Prompt:
         for k, v in fields.items():
             setattr(self, k, v)
         # status e ('eligible', 'used', 'removed')
+        loaders = get_loaders(context)
+        loaders.posts.queue(fields.get("post_id"))
+        loaders.rounds_by_prompt.queue(fields.get("id"))
 
     @property
     def _db_conn(self):
         return self._context["db-conn"]
 
-    @property
+    @cached_property
     def post(self):
-        posts = models.posts
-        stmt = sqlalchemy.select(posts).where(posts.c.id == self.post_id)
-        result = self._db_conn.execute(stmt).fetchone()
-        return resolvers.posts.Post(self._context, result._asdict())
+        result = get_loaders(self._context).posts.load(self.post_id)
+        return resolvers.posts.Post(self._context, result)
 
-    @property
-    def replies(self):
-        return self.get_replies()
+    def replies(self, info=None, first=5, after=None):
+        # called by GraphQL with the arguments of Prompt.replies.
+        return self.get_replies(first, after).plan(info, "Post")
 
     def get_replies(self, first=5, after=None):
-        conn = self._context["db-conn"]
+        """
+        Returns the Connection of the replies after the cursor after, see
+        api.connections.
+        """
         db_posts = models.posts
-
-        # Convert the 'after' cursor to an integer offset
-        offset = int(after) if after else 0
-
-        reply_stmt = (
-            sqlalchemy.select(db_posts)
-            .where(
-                db_posts.c.in_reply_to == self.post_id,
-                db_posts.c.mod_removed == False,  # noqa: E712
-            )
-            .order_by(db_posts.c.id)
-            .limit(first)
-            .offset(offset)
+        reply_stmt = sqlalchemy.select(db_posts).where(
+            db_posts.c.in_reply_to == self.post_id,
+            db_posts.c.mod_removed == False,  # noqa: E712
         )
 
         resolverPost = resolvers.posts.Post
@@ -87,96 +89,106 @@ class Prompt:
 
             resolverPost = BridgedPost
 
-        objs = [
-            {
-                "cursor": str(offset + i + 1),
-                "node": resolverPost(self._context, p._asdict()),
-            }
-            for i, p in enumerate(conn.execute(reply_stmt))
-        ]
-
-        has_next_page = len(objs) == first
-
-        return {
-            "edges": objs,
-            "pageInfo": {
-                "endCursor": objs[-1]["cursor"] if objs else None,
-                "hasNextPage": has_next_page,
-            },
-        }
+        return Connection(
+            self._context,
+            reply_stmt,
+            db_posts.c.id,
+            lambda fields: resolverPost(self._context, fields),
+            first,
+            after,
+        )
 
     @property
     def num_replies(self):
-        conn = self._context["db-conn"]
-
         try:
             round = self.round
         except:  # noqa: E722
             return 0
 
-        if round.archived:
-            result = conn.execute(
-                sqlalchemy.text("""
-                                    SELECT
-                                        p.id AS post_id,
-                                        COUNT(r.id) AS reply_count
-                                    FROM
-                                        posts p
-                                    LEFT JOIN
-                                        posts r ON r.in_reply_to = p.id
-                                    LEFT JOIN
-                                        mod_disputes d ON d.post_id = r.id AND d.status != 'resolved'
-                                    LEFT JOIN
-                                        audios a ON a.id = r.audio_id
-                                    WHERE
-                                        p.id = :post_id
-                                        AND r.mod_removed <> true
-                                        AND r.in_reply_to IS NOT NULL
-                                        AND d.id IS NULL
-                                        AND a.available_mp3 = true
-                                    GROUP BY
-                                        p.id
-                                """),
-                {"post_id": self.post_id},
-            ).fetchall()
-            if len(result) == 1:
-                return result[0][1]
-
-        result = conn.execute(
-            sqlalchemy.text(
-                """
-                    SELECT
-                        count(*)
-                    FROM
-                        posts p
-                    LEFT JOIN
-                        audios a ON a.id = p.audio_id
-                    WHERE
-                        p.in_reply_to = :post_id
-                        AND p.mod_removed <> true
-                        AND a.available_mp3 = true
-            """
-            ),
-            {"post_id": self.post_id},
-        )
-        return [row._asdict()["count"] for row in result][0]
+        # replies with open disputes are left out once the round is
+        # archived, unless that leaves none.
+        if round.archived and self.visible_reply_count:
+            return self.visible_reply_count
+        return self.reply_count
 
-    @property
+    @cached_property
     def author(self):
         return resolvers.personas.Personas.get(self._context, self.post.author_id)
 
-    @property
+    @cached_property
     def round(self):
-        rounds = models.rounds
-        stmt = sqlalchemy.select(rounds).where(rounds.c.prompt_id == self.id)
-        result = self._db_conn.execute(stmt).fetchone()
-        return resolvers.rounds.Round(self._context, result._asdict())
+        loaders = get_loaders(self._context)
+        result = loaders.rounds_by_prompt.load(self.id)
+        if result is None:
+            raise Exception(f"Prompt.id {self.id} has no round")
+        return loaders.identity_map.get_or_build(
+            "rounds",
+            result,
+            lambda fields: resolvers.rounds.Round(self._context, fields),
+        )
 
     @property
     def is_active(self):
         return self.status == "active"
 
 
+def refresh_reply_counts(context, post_ids=None):
+    """
+    Stores the reply counts of the prompts whose post is in post_ids, a list
+    or a select of ids, or of every prompt. Writers call it whenever a reply
+    is created or removed, its mp3 becomes available, or one of its disputes
+    is opened or resolved. Returns the ids of the prompts that changed.
+    """
+    posts = models.posts
+    audios = models.audios
+    prompts = models.prompts
+    open_disputes = (
+        sqlalchemy.select(models.mod_disputes.c.id)
+        .where(models.mod_disputes.c.post_id == posts.c.id)
+        .where(models.mod_disputes.c.status != "resolved")
+        .exists()
+    )
+    replies = sqlalchemy.select(
+        posts.c.in_reply_to,
+        sqlalchemy.func.count().label("replies"),
+        sqlalchemy.func.count().filter(~open_disputes).label("visible_replies"),
+    ).join(audios, audios.c.id == posts.c.audio_id)
+    replies = replies.where(
+        posts.c.mod_removed != True,  # noqa: E712
+        audios.c.available_mp3 == True,  # noqa: E712
+    )
+    if post_ids is not None:
+        replies = replies.where(posts.c.in_reply_to.in_(post_ids))
+    else:
+        replies = replies.where(posts.c.in_reply_to.isnot(None))
+    replies = replies.group_by(posts.c.in_reply_to).subquery()
+
+    counts = sqlalchemy.select(
+        prompts.c.id,
+        sqlalchemy.func.coalesce(replies.c.replies, 0).label("replies"),
+        sqlalchemy.func.coalesce(replies.c.visible_replies, 0).label("visible"),
+    ).outerjoin(replies, replies.c.in_reply_to == prompts.c.post_id)
+    if post_ids is not None:
+        counts = counts.where(prompts.c.post_id.in_(post_ids))
+    counts = counts.subquery()
+
+    stmt = (
+        sqlalchemy.update(prompts)
+        .where(prompts.c.id == counts.c.id)
+        .where(
+            prompts.c.reply_count.is_distinct_from(counts.c.replies)
+            | prompts.c.visible_reply_count.is_distinct_from(counts.c.visible)
+        )
+        .values(reply_count=counts.c.replies, visible_reply_count=counts.c.visible)
+        .returning(prompts.c.id)
+    )
+    changed = context["db-conn"].execute(stmt).scalars().all()
+    loaders = get_loaders(context)
+    for prompt_id in changed:
+        loaders.clear("prompts", prompt_id)
+    return changed
+
+
 def create_prompt_with_post(
     context, text, community_id, author_id, foraConv_id, in_reply_to, priority
 ):
@@ -203,6 +215,7 @@ def create_prompt_with_post(
     new_prompt_id = result.inserted_primary_key[0]
 
     conn.commit()  # FIXME shouldn't this commit go before the queried result?
+    get_loaders(context).prompts_by_post.clear(new_post.id)
 
     # Return the IDs of the newly created prompt and post
     return {"prompt_id": new_prompt_id, "post_id": new_post.id}
@@ -228,6 +241,8 @@ def get_lowest_priority_prompt(context, community_id):
         )
         .order_by(prompts.c.priority)
         .limit(1)
+        # a prompt being picked by a concurrent round transition is skipped.
+        .with_for_update(skip_locked=True, of=prompts)
     )
     result = conn.execute(stmt).fetchone()
     if result:
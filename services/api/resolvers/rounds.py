@@ -1,8 +1,12 @@
+from functools import cached_property
+
 import sqlalchemy
 from sqlalchemy import update, insert
 
 import db.models
 import api.resolvers
+from api.cache import invalidate
+from api.loaders import get_loaders
 from api.time import time
 from api.notifications import send_round_has_closed_notification
 
@@ -25,36 +29,69 @@ class Rounds:
         if prompt_id is not None:
             stmt = stmt.where(db.models.rounds.c.prompt_id == prompt_id)
 
-        stmt = stmt.order_by(sqlalchemy.desc(db.models.rounds.c.id))
-
-        # FIXME(bcsaldias): ideally we'll have a lazy field in Round that calculates the status
-        rounds = [Round(context, r._asdict()) for r in conn.execute(stmt)]
+        # a round's stored status is its status as of the last
+        # refresh_round_statuses, the one asked for or an earlier one. It
+        # narrows the rounds through round_status_index, and their status is
+        # then computed at the current time, as Round.status is. Archived
+        # rounds, the history, are only filtered on the stored status, since
+        # every stored status could have become archived.
+        if status == "archived":
+            stmt = stmt.where(db.models.rounds.c.status == status)
+        elif status is not None:
+            rounds = db.models.rounds
+            if status in STATUS_ORDER:
+                earlier = STATUS_ORDER[: STATUS_ORDER.index(status) + 1]
+                stmt = stmt.where(
+                    sqlalchemy.or_(
+                        rounds.c.status.in_(earlier), rounds.c.status.is_(None)
+                    )
+                )
+            stmt = stmt.where(status_at(time.utcnow()) == status)
 
-        if status is not None:
-            rounds = list(filter(lambda r: r.status == status, rounds))
+        # order by recency, and only return requested amount if relevant
+        stmt = stmt.order_by(sqlalchemy.desc(db.models.rounds.c.id))
         if how_many is not None:
-            # stmt = stmt.limit(how_many)
-            rounds = rounds[:how_many]
+            stmt = stmt.limit(how_many)
 
-        # order by recency, and only return requested amount if relevant
-        self._rounds = rounds
+        self._rounds = Rounds.from_rows(context, conn.execute(stmt))
 
     def all(self):
         return self._rounds
 
+    @classmethod
+    def from_rows(_, context, rows):
+        """
+        Returns the Rounds of rows, which are stored in the request's loaders
+        so that Prompt.round, e.g. for Prompt.num_replies, finds them
+        instead of querying each round again.
+        """
+        loaders = get_loaders(context)
+        rounds = []
+        for row in rows:
+            row = row._asdict()
+            loaders.prime("rounds", row, replace=False)
+            rounds.append(
+                loaders.identity_map.get_or_build(
+                    "rounds", row, lambda fields: Round(context, fields)
+                )
+            )
+        return rounds
+
     @classmethod
     def get(_, context, id=None):
         """
         This method returs a Round.
         """
-        if id is not None:
-            stmt = sqlalchemy.select(db.models.rounds).where(
-                db.models.rounds.c.id == id
-            )
-        fetched_round = context["db-conn"].execute(stmt).fetchone()
+        loaders = get_loaders(context)
+        round = loaders.identity_map.get("rounds", id)
+        if round is not None:
+            return round
+        fetched_round = loaders.rounds.load(id)
         if fetched_round is None:
             raise Exception(f"Round.id {id} doesn't exist")
-        return Round(context, fetched_round._asdict())
+        return loaders.identity_map.get_or_build(
+            "rounds", fetched_round, lambda fields: Round(context, fields)
+        )
 
     @classmethod
     def create(
@@ -72,26 +109,76 @@ class Rounds:
         )
         result = conn.execute(stmt)
         new_round_id = result.inserted_primary_key[0]
+        refresh_round_statuses(context, [community_id])
+        # see jobs.round_scheduler
+        invalidate(conn, "round_deadlines", community_id)
         conn.commit()
+        get_loaders(context).rounds_by_prompt.clear(prompt_id)
         return new_round_id
 
 
+# the statuses a round goes through as time passes.
+STATUS_ORDER = ("eligible", "accept_answers", "completed", "archived")
+
+
+def status_at(now):
+    """SQL expression of Round.status at instant now."""
+    rounds = db.models.rounds
+    return sqlalchemy.case(
+        (rounds.c.end_time <= now, "archived"),
+        (rounds.c.completion_time <= now, "completed"),
+        (rounds.c.start_time <= now, "accept_answers"),
+        (
+            sqlalchemy.or_(rounds.c.start_time.is_(None), rounds.c.start_time > now),
+            "eligible",
+        ),
+        else_="erroneous",
+    )
+
+
+def refresh_round_statuses(context, community_ids=None):
+    """
+    Stores the current status of the rounds whose status changed since it
+    was last stored, in community_ids if given. Returns their rows.
+    Called by the round workers at each round deadline, and whenever
+    round times are changed.
+    """
+    rounds = db.models.rounds
+    now = time.utcnow()
+    status = status_at(now)
+    stmt = (
+        update(rounds)
+        .where(rounds.c.status.is_distinct_from(status))
+        .values(status=status, status_time=now)
+        .returning(rounds)
+    )
+    if community_ids is not None:
+        stmt = stmt.where(rounds.c.community_id.in_(community_ids))
+    else:
+        # archived is the last status, those rounds don't change anymore.
+        stmt = stmt.where(rounds.c.status.is_distinct_from("archived"))
+    updated = [r._asdict() for r in context["db-conn"].execute(stmt)]
+    loaders = get_loaders(context)
+    for row in updated:
+        loaders.clear("rounds", row["id"])
+    return updated
+
+
 class Round:
     def __init__(self, context, fields):
         self._context = context
         self._fields = fields
         for k, v in fields.items():
-            setattr(self, k, v)
+            # status is computed from the round times, see status.
+            if k != "status":
+                setattr(self, k, v)
+        get_loaders(context).prompts.queue(fields.get("prompt_id"))
 
-    @property
+    @cached_property
     def prompt(self):
-        conn = self._context["db-conn"]
-        prompts = db.models.prompts
-        stmt = sqlalchemy.select(prompts).where(prompts.c.id == self.prompt_id)
-        result = conn.execute(stmt).fetchone()
-        return api.resolvers.prompts.Prompt(self._context, result._asdict())
+        return api.resolvers.prompts.Prompts.get(self._context, id=self.prompt_id)
 
-    @property
+    @cached_property
     def community(self):
         return self.prompt.post.community
 
@@ -105,11 +192,14 @@ class Round:
         conn = self._context["db-conn"]
         stmt = (
             update(db.models.prompts)
-            .where(db.models.prompts.c.id == self.prompt.id)
+            .where(db.models.prompts.c.id == self.prompt_id)
             .values(status=status)
         )
         conn.execute(stmt)
         conn.commit()
+        get_loaders(self._context).clear("prompts", self.prompt_id)
+        # the memoized prompt, if any, still has the previous status.
+        self.__dict__.pop("prompt", None)
         return self.id
 
     @property
@@ -138,10 +228,9 @@ class Round:
 
     @property
     def completed(self):
-        value = time.utcnow() >= self.completion_time and not self.archived
-        if value and not self.completion_notif_sent:
-            send_round_has_closed_notification(self, self.community)
-        return value
+        # the closed notification is sent by the round workers, see
+        # jobs.round_scheduler.process_communities.
+        return time.utcnow() >= self.completion_time and not self.archived
 
     @property
     def closed(self):
@@ -164,7 +253,10 @@ class Round:
             .values(end_time=time.utcnow())
         )
         conn.execute(stmt)
+        refresh_round_statuses(self._context, [self.community_id])
+        invalidate(conn, "round_deadlines", self.community_id)
         conn.commit()
+        get_loaders(self._context).clear("rounds", self.id)
         return True
 
     def close_now(self):
@@ -181,28 +273,32 @@ class Round:
             .values(completion_time=time.utcnow())
         )
         conn.execute(stmt)
+        refresh_round_statuses(self._context, [self.community_id])
+        invalidate(conn, "round_deadlines", self.community_id)
         conn.commit()
+        get_loaders(self._context).clear("rounds", self.id)
         return True
 
     def mark_notification_as_sent(self, notif):
-        # FIXME(bcsaldias): I'm sure there is a smarter way.
-        # Quick prototype here.
+        """
+        Marks notif, start_notif_sent or completion_notif_sent, as sent, on
+        the caller's transaction. Returns False if it already was, e.g. by a
+        concurrent worker, which holds the row until its transaction ends.
+        """
+        assert notif in ["start_notif_sent", "completion_notif_sent"]
         conn = self._context["db-conn"]
-        if notif == "start_notif_sent":
-            stmt = (
-                update(db.models.rounds)
-                .where(db.models.rounds.c.id == self.id)
-                .values(start_notif_sent=True)
-            )
-        if notif == "completion_notif_sent":
-            stmt = (
-                update(db.models.rounds)
-                .where(db.models.rounds.c.id == self.id)
-                .values(completion_notif_sent=True)
-            )
-        conn.execute(stmt)
-        conn.commit()
-        return True
+        rounds = db.models.rounds
+        stmt = (
+            update(rounds)
+            .where(rounds.c.id == self.id)
+            .where(rounds.c[notif].isnot(True))
+            .values({notif: True})
+            .returning(rounds.c.id)
+        )
+        claimed = conn.execute(stmt).first() is not None
+        setattr(self, notif, True)
+        get_loaders(self._context).clear("rounds", self.id)
+        return claimed
 
     def allows_answering_by(self, persona):
         """
@@ -1,13 +1,28 @@
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from sqlalchemy import select, insert
+from sqlalchemy import bindparam, select, insert, update
 
+from api.cache import TTLCache
+from api.loaders import get_loaders
 from api.time import time
 import db.models as models
 
 logger = logging.getLogger("api.siwf_accounts")
 
+# Seconds before a handle is fetched again from the accounts gateway.
+MSA_HANDLE_TTL = int(os.environ.get("MSA_HANDLE_TTL", 60 * 60))
+
+_missing = object()
+_msa_handles = TTLCache(maxsize=10000, ttl=MSA_HANDLE_TTL)
+# msa_ids being refreshed in the background, and failed fetches, which
+# aren't retried for a minute.
+_refreshing = TTLCache(maxsize=10000, ttl=60)
+_failures = TTLCache(maxsize=10000, ttl=60)
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="msa-handles")
+
 class SIWFAccounts:
     base_url = os.environ.get("FREQUENCY_ACCOUNTS_GATEWAY_URI")
 
@@ -90,6 +105,7 @@ class SIWFAccounts:
             )
             session.execute(stmt)
             session.commit()
+            get_loaders(context).frequency_metadata.clear(persona_id)
         except Exception as e:
             session.rollback()
             logger.error(f"Error inserting frequency metadata for persona {persona_id}: {e}")
@@ -118,23 +134,111 @@ class SIWFAccounts:
             logger.error(f"Error while fetching MSA ID: {e}")
             raise ValueError("Unable to retrieve MSA ID from account API.")
 
+    @classmethod
+    def fetch_msa_handle(cls, msa_id):
+        """Requests the handle of msa_id from the accounts gateway."""
+        account_api_url = f"{cls.base_url}/v1/accounts/{msa_id}"
+        try:
+            response = requests.get(account_api_url)
+            response.raise_for_status()
+
+            response_data = response.json()
+            return response_data.get("handle", {}).get("base_handle")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error while fetching MSA handle: {e}")
+            raise ValueError("Unable to retrieve MSA handle from account API.")
+
     @classmethod
     def get_msa_handle_for_persona(cls, context, persona_id):
-        session = context["session"]
-        metadata_stmt = select(models.frequency_metadata.c.msa_id).where(models.frequency_metadata.c.persona_id == persona_id)
-        result = session.execute(metadata_stmt).fetchone()
+        """Returns the handle of persona_id, None if it has no msa_id.
+
+        Handles are kept in _msa_handles and in frequency_metadata. A handle
+        older than MSA_HANDLE_TTL is still returned, and refreshed in the
+        background. Handles never fetched before are fetched concurrently for
+        every persona loaded by the request.
+        """
+        metadata = get_loaders(context).frequency_metadata.load(persona_id)
+        if metadata is None:
+            return None
+
+        msa_id = metadata["msa_id"]
+        handle = _msa_handles.get(msa_id, _missing)
+        if handle is not _missing:
+            return handle
+
+        if metadata["msa_handle_time"] is not None:
+            expired_at = time.utcnow().shift(seconds=-MSA_HANDLE_TTL)
+            if metadata["msa_handle_time"] < expired_at:
+                cls.refresh_msa_handle(context, msa_id)
+            else:
+                _msa_handles.set(msa_id, metadata["msa_handle"])
+            return metadata["msa_handle"]
 
-        msa_id = result.msa_id if result else None
-        if msa_id:
-            account_api_url = f"{cls.base_url}/v1/accounts/{msa_id}"
+        if msa_id not in _failures:
+            cls._fetch_pending_msa_handles(context)
+        error = _failures.get(msa_id)
+        if error is not None:
+            raise error
+        return _msa_handles.get(msa_id)
+
+    @classmethod
+    def _fetch_pending_msa_handles(cls, context):
+        """Fetches the handles of the request's personas that have none yet."""
+        msa_ids = [
+            row["msa_id"]
+            for row in get_loaders(context).frequency_metadata.loaded()
+            if row["msa_handle_time"] is None
+            and row["msa_id"] not in _msa_handles
+            and row["msa_id"] not in _failures
+        ]
+
+        def fetch(msa_id):
             try:
-                response = requests.get(account_api_url)
-                response.raise_for_status()
+                return cls.fetch_msa_handle(msa_id)
+            except ValueError as e:
+                return e
+
+        handles = {}
+        for msa_id, handle in zip(msa_ids, _executor.map(fetch, msa_ids)):
+            if isinstance(handle, ValueError):
+                _failures.set(msa_id, handle)
+            else:
+                handles[msa_id] = handle
+                _msa_handles.set(msa_id, handle)
+
+        if handles:
+            _executor.submit(_store_msa_handles, context["db-conn"].engine, handles)
 
-                response_data = response.json()
-                return response_data.get("handle", {}).get("base_handle") 
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error while fetching MSA handle: {e}")
-                raise ValueError("Unable to retrieve MSA handle from account API.")
+    @classmethod
+    def refresh_msa_handle(cls, context, msa_id):
+        """Fetches and stores the handle of msa_id in the background."""
+        if not _refreshing.add(msa_id):
+            return
 
-        return None
+        def refresh(engine):
+            try:
+                handle = cls.fetch_msa_handle(msa_id)
+            except ValueError:
+                return
+            _msa_handles.set(msa_id, handle)
+            _store_msa_handles(engine, {msa_id: handle})
+
+        _executor.submit(refresh, context["db-conn"].engine)
+
+
+def _store_msa_handles(engine, handles):
+    frequency_metadata = models.frequency_metadata
+    stmt = (
+        update(frequency_metadata)
+        .where(frequency_metadata.c.msa_id == bindparam("b_msa_id"))
+        .values(msa_handle=bindparam("b_msa_handle"), msa_handle_time=time.utcnow())
+    )
+    values = [
+        {"b_msa_id": msa_id, "b_msa_handle": handle}
+        for msa_id, handle in handles.items()
+    ]
+    try:
+        with engine.begin() as conn:
+            conn.execute(stmt, values)
+    except Exception as e:
+        logger.error(f"Error storing MSA handles: {e}")
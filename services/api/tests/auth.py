@@ -3,12 +3,115 @@ from services/
 python3 -m unittest api/tests/auth.py
 """
 
+import asyncio
+import base64
+import secrets
 import unittest
+from hashlib import blake2b
+from types import SimpleNamespace
+from unittest import mock
+
+from substrateinterface import Keypair
+
+from api import auth
+from api.auth import get_context_value, v1_auth_middleware
+from api.exceptions import UnauthorizedError
+from api.time import time
+
+
+class FakeRequest:
+    def __init__(self, headers, body):
+        self.headers = headers
+        self._body = body
+
+    async def body(self):
+        return self._body
+
+
+def int_list(value):
+    return ",".join(map(str, value))
+
+
+def signed_request(body, keypair=None, encode=int_list, sent_at=None, **headers):
+    keypair = keypair or Keypair.create_from_mnemonic(Keypair.generate_mnemonic())
+    sent_at = sent_at or str(int(time.utcnow().timestamp() * 1000))
+    nonce = "0x" + secrets.token_hex(16)
+    message = ".".join([sent_at, nonce, body]).encode("utf-8")
+    values = {
+        "persona-pkh": "0x" + blake2b(keypair.public_key, digest_size=32).hexdigest(),
+        "x-sent-at": sent_at,
+        "x-nonce": nonce,
+        "x-pubkey": encode(keypair.public_key),
+        "x-sig": encode(keypair.sign(message)),
+    }
+    values.update(headers)
+    return FakeRequest(values, body.encode("utf-8"))
+
+
+def resolve(context):
+    info = SimpleNamespace(context=context)
+    return v1_auth_middleware(lambda obj, info: "resolved", None, info)
 
 
 class TestAuthMethods(unittest.TestCase):
     def test_auth(self):
-        pass
+        request = signed_request('{"query": "{ communities { id } }"}')
+        context = asyncio.run(get_context_value(request, {}))
+        self.assertIsNone(context["v1-auth-failure"])
+        self.assertEqual("resolved", resolve(context))
+
+    def test_auth_failures(self):
+        body = '{"query": "{ communities { id } }"}'
+        failures = {
+            "failed authentication": signed_request(body, **{"x-nonce": "0xother"}),
+            "missing persona pkh": signed_request(body, **{"persona-pkh": ""}),
+            "missing required auth header": FakeRequest(
+                {"persona-pkh": "0x00"}, body.encode("utf-8")
+            ),
+        }
+        for failure, request in failures.items():
+            context = asyncio.run(get_context_value(request, {}))
+            self.assertEqual(failure, context["v1-auth-failure"])
+            with self.assertRaises(UnauthorizedError):
+                resolve(context)
+
+    def test_auth_replayed_nonce(self):
+        request = signed_request('{"query": "{ communities { id } }"}')
+        context = asyncio.run(get_context_value(request, {}))
+        self.assertIsNone(context["v1-auth-failure"])
+        context = asyncio.run(get_context_value(request, {}))
+        self.assertEqual("failed authentication", context["v1-auth-failure"])
+
+    def test_auth_expired_request(self):
+        body = '{"query": "{ communities { id } }"}'
+        window = auth.AUTH_NONCE_WINDOW
+        sent_at = time.utcnow().shift(seconds=-window - 1)
+        request = signed_request(body, sent_at=str(int(sent_at.timestamp() * 1000)))
+        context = asyncio.run(get_context_value(request, {}))
+        self.assertEqual("failed authentication", context["v1-auth-failure"])
+
+        # a request accepted once is still rejected after its nonce has
+        # left the cache, as soon as it is sent outside of the window.
+        request = signed_request(body)
+        context = asyncio.run(get_context_value(request, {}))
+        self.assertIsNone(context["v1-auth-failure"])
+        auth._seen_nonces.clear()
+        later = time.utcnow().shift(seconds=window + 1)
+        with mock.patch.object(auth.time, "utcnow", return_value=later):
+            context = asyncio.run(get_context_value(request, {}))
+        self.assertEqual("failed authentication", context["v1-auth-failure"])
+
+    def test_auth_key_encodings(self):
+        body = '{"query": "{ communities { id } }"}'
+        encodings = [
+            lambda value: "0x" + bytes(value).hex(),
+            lambda value: base64.b64encode(bytes(value)).decode("ascii"),
+        ]
+        keypair = Keypair.create_from_mnemonic(Keypair.generate_mnemonic())
+        for encode in encodings:
+            request = signed_request(body, keypair=keypair, encode=encode)
+            context = asyncio.run(get_context_value(request, {}))
+            self.assertIsNone(context["v1-auth-failure"])
 
 
 if __name__ == "__main__":
@@ -8,6 +8,7 @@ import sys
 
 sys.path.append("./")
 import db.models
+from api import cache
 
 load_dotenv()
 engine_name = f"postgresql+psycopg2://{os.environ['DB_CONNECTION_STRING']}"
@@ -146,6 +147,12 @@ class TestBase(unittest.TestCase):
             )
             conn.execute(stmt)
             conn.commit()
+            # remove frequency metadata
+            stmt = sqlalchemy.delete(db.models.frequency_metadata).where(
+                db.models.frequency_metadata.c.persona_id <= persona["id"]
+            )
+            conn.execute(stmt)
+            conn.commit()
             # remove personas
             stmt = sqlalchemy.delete(db.models.personas).where(
                 db.models.personas.c.id <= persona["id"]
@@ -186,6 +193,8 @@ class TestBase(unittest.TestCase):
             )
             conn.execute(stmt)
             conn.commit()
+        # rows above were deleted behind the API's back.
+        cache.clear_all()
         del context
 
     def test_init(self):
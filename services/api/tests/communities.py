@@ -4,10 +4,23 @@ python3 -m unittest api/tests/communities.py
 """
 
 import sys
+import threading
 
 sys.path.append("./")
+import time
 import unittest
-from api.resolvers import Personas, Communities
+from unittest import mock
+
+import db.models
+import sqlalchemy
+from api import cache, loaders, notification_handlers, notifications, outbox
+from api.fake_fcm import FakeFCM
+from api.resolvers import Audios, Personas, Communities, Prompts, Rounds
+from api.resolvers import posts as posts_resolvers
+from api.resolvers.communities import round_transition_lock
+from api.resolvers.prompts import refresh_reply_counts
+from api.resolvers.rounds import refresh_round_statuses
+from api.time import time as api_time
 from api.tests import TestBase, get_context, test_values
 
 
@@ -38,6 +51,623 @@ class TestCommunityMethods(TestBase):
         context["db-conn"].commit()
         self.assertEqual(m_status, "already unregistered")
 
+    def test_members_connection(self):
+        """
+        Testing members are paged by id, with their total count.
+        """
+        context = get_context()
+        conn = context["db-conn"]
+        cid = test_values["communities"][3]["id"]
+        memberships = db.models.memberships
+        pids = [test_values["personas"][i]["id"] for i in range(30, 35)]
+        conn.execute(
+            sqlalchemy.insert(memberships),
+            [{"persona_id": pid, "community_id": cid} for pid in pids],
+        )
+        conn.commit()
+
+        def cleanup():
+            conn.rollback()
+            stmt = sqlalchemy.delete(memberships).where(
+                memberships.c.community_id == cid,
+                memberships.c.persona_id.in_(pids),
+            )
+            conn.execute(stmt)
+            conn.commit()
+
+        self.addCleanup(cleanup)
+
+        community = Communities.get(context, id=cid)
+        members = sorted(persona.id for persona in community.members)
+        self.assertEqual(sorted(pids), members)
+
+        ids, after = [], None
+        while True:
+            page = community.members_connection(first=2, after=after)
+            self.assertLessEqual(len(page.edges), 2)
+            self.assertEqual(len(members), page.totalCount)
+            ids.extend(node.id for node in page.nodes)
+            after = page.pageInfo["endCursor"]
+            if not page.pageInfo["hasNextPage"]:
+                break
+        self.assertEqual(members, ids)
+        self.assertEqual([], community.members_connection(after=members[-1]).edges)
+
+    def test_community_flags(self):
+        """
+        Testing _FLAG_ attributes follow the community flags.
+        """
+        context = get_context()
+        cids = [c["id"] for c in test_values["communities"][1:3]]
+        c0, c1 = [Communities.get(context, id=cid) for cid in cids]
+        self.assertFalse(c0._FLAG_enabled_mod_actions)
+
+        c0.add_flag("enable_content_moderation_moderator_actions")
+        self.assertTrue(c0._FLAG_enabled_mod_actions)
+        self.assertTrue(c0._FLAG_enable_content_moderation_moderator_actions)
+        self.assertFalse(c1._FLAG_enabled_mod_actions)
+        with self.assertRaises(AttributeError):
+            c0._FLAG_unknown_flag
+
+        c0.remove_flag("enable_content_moderation_moderator_actions")
+        self.assertFalse(c0._FLAG_enabled_mod_actions)
+
+    def test_community_cache_invalidation(self):
+        """
+        Testing cached community rows are dropped by updates made through
+        another connection, as another API instance would.
+        """
+        stop = threading.Event()
+        listener = cache.listen(
+            get_context()["db-conn"].engine, poll_timeout=0.1, stop=stop
+        )
+        self.addCleanup(listener.join)
+        self.addCleanup(stop.set)
+        cid = test_values["communities"][3]["id"]
+        community = Communities.get(get_context(), id=cid)
+        self.assertEqual(loaders.community_rows.get(cid)["name"], community.name)
+
+        other_context = get_context()
+        conn = other_context["db-conn"]
+        stmt = (
+            sqlalchemy.update(db.models.communities)
+            .where(db.models.communities.c.id == cid)
+            .values(name="unittest_renamed")
+        )
+        conn.execute(stmt)
+        cache.invalidate(conn, "communities", cid)
+        # only dropped locally, the NOTIFY is sent on commit.
+        loaders.community_rows.set(cid, community._fields)
+        conn.commit()
+
+        for _ in range(50):
+            if cid not in loaders.community_rows:
+                break
+            time.sleep(0.1)
+        self.assertEqual(
+            Communities.get(get_context(), id=cid).name, "unittest_renamed"
+        )
+
+    def test_community_cache_sync(self):
+        """
+        Testing cache.sync applies the invalidations committed by another
+        connection before it is called, without a listening thread.
+        """
+        engine = get_context()["db-conn"].engine
+        cache.sync(engine)
+        cid = test_values["communities"][3]["id"]
+        community = Communities.get(get_context(), id=cid)
+
+        conn = get_context()["db-conn"]
+        cache.invalidate(conn, "communities", cid)
+        loaders.community_rows.set(cid, community._fields)
+        conn.commit()
+        self.assertTrue(cid in loaders.community_rows)
+        cache.sync(engine)
+        self.assertFalse(cid in loaders.community_rows)
+
+    def test_community_cache_rollback(self):
+        """
+        Testing rows read after an invalidation, before the transaction
+        commits, aren't cached by the process.
+        """
+        cid = test_values["communities"][3]["id"]
+        name = Communities.get(get_context(), id=cid).name
+
+        context = get_context()
+        conn = context["db-conn"]
+        stmt = (
+            sqlalchemy.update(db.models.communities)
+            .where(db.models.communities.c.id == cid)
+            .values(name="unittest_rolled_back")
+        )
+        conn.execute(stmt)
+        cache.invalidate(conn, "communities", cid)
+        community = Communities.get(context, id=cid)
+        self.assertEqual(community.name, "unittest_rolled_back")
+        self.assertFalse(cid in loaders.community_rows)
+        conn.rollback()
+
+        self.assertEqual(Communities.get(get_context(), id=cid).name, name)
+        self.assertEqual(loaders.community_rows.get(cid)["name"], name)
+
+    def test_needing_round_transition(self):
+        """
+        Testing the round worker only gets communities with eligible prompts
+        and no active round, or with a round to close.
+        """
+        context = get_context()
+        conn = context["db-conn"]
+        cid = test_values["communities"][0]["id"]
+        post_id = test_values["posts"][0]["id"]
+
+        def needing():
+            return [c.id for c in Communities.needing_round_transition(context)]
+
+        self.assertFalse(cid in needing())
+
+        stmt = sqlalchemy.insert(db.models.prompts).values(
+            post_id=post_id, priority=1, status="eligible"
+        )
+        prompt_id = conn.execute(stmt).inserted_primary_key[0]
+        conn.commit()
+        rounds = db.models.rounds
+
+        def cleanup():
+            conn.rollback()
+            stmt = sqlalchemy.delete(rounds).where(rounds.c.prompt_id == prompt_id)
+            conn.execute(stmt)
+            stmt = sqlalchemy.delete(db.models.prompts).where(
+                db.models.prompts.c.id == prompt_id
+            )
+            conn.execute(stmt)
+            conn.commit()
+
+        self.addCleanup(cleanup)
+        self.assertTrue(cid in needing())
+
+        now = api_time.utcnow()
+        stmt = sqlalchemy.insert(db.models.rounds).values(
+            prompt_id=prompt_id,
+            community_id=cid,
+            creation_time=now.shift(hours=-2),
+            start_time=now.shift(hours=-2),
+            completion_time=now.shift(hours=1),
+            end_time=now.shift(hours=2),
+        )
+        round_id = conn.execute(stmt).inserted_primary_key[0]
+        conn.commit()
+        # the active round is accepting answers.
+        self.assertFalse(cid in needing())
+
+        stmt = (
+            sqlalchemy.update(rounds)
+            .where(rounds.c.id == round_id)
+            .values(completion_time=now.shift(hours=-1))
+        )
+        conn.execute(stmt)
+        conn.commit()
+        self.assertTrue(cid in needing())
+
+        stmt = (
+            sqlalchemy.update(rounds)
+            .where(rounds.c.id == round_id)
+            .values(completion_notif_sent=True)
+        )
+        conn.execute(stmt)
+        conn.commit()
+        self.assertFalse(cid in needing())
+
+    def test_round_transition_lock(self):
+        """
+        Testing round transitions of a community are serialized across
+        connections.
+        """
+        cid = test_values["communities"][0]["id"]
+        context, other_context = get_context(), get_context()
+        with round_transition_lock(context, cid, wait=False) as locked:
+            self.assertTrue(locked)
+            with round_transition_lock(other_context, cid, wait=False) as locked:
+                self.assertFalse(locked)
+            # other communities aren't locked.
+            with round_transition_lock(other_context, cid - 1, wait=False) as locked:
+                self.assertTrue(locked)
+        with round_transition_lock(other_context, cid, wait=False) as locked:
+            self.assertTrue(locked)
+
+        # a failing transition only rolls back its own changes, and a
+        # transition is committed before the lock is released.
+        communities = db.models.communities
+        conn = context["db-conn"]
+        stmt = sqlalchemy.select(communities.c.name).where(communities.c.id == cid)
+        name = conn.execute(stmt).scalar()
+
+        def rename(new_name):
+            conn.execute(
+                sqlalchemy.update(communities)
+                .where(communities.c.id == cid)
+                .values(name=new_name)
+            )
+
+        def cleanup():
+            conn.rollback()
+            rename(name)
+            conn.commit()
+
+        self.addCleanup(cleanup)
+
+        rename("unittest_before_lock")
+        with self.assertRaises(RuntimeError):
+            with round_transition_lock(context, cid):
+                rename("unittest_in_lock")
+                raise RuntimeError()
+        self.assertEqual("unittest_before_lock", conn.execute(stmt).scalar())
+        with round_transition_lock(context, cid):
+            rename("unittest_locked")
+        other_conn = other_context["db-conn"]
+        self.assertEqual("unittest_locked", other_conn.execute(stmt).scalar())
+
+    def test_round_statuses(self):
+        """
+        Testing round statuses are stored as they change, and rounds are
+        filtered on them.
+        """
+        context = get_context()
+        conn = context["db-conn"]
+        cid = test_values["communities"][1]["id"]
+        post_id = test_values["posts"][1]["id"]
+        rounds = db.models.rounds
+
+        stmt = sqlalchemy.insert(db.models.prompts).values(
+            post_id=post_id, priority=1, status="used"
+        )
+        prompt_id = conn.execute(stmt).inserted_primary_key[0]
+        now = api_time.utcnow()
+        round_ids = []
+        for days in [-3, -2, -1]:
+            stmt = sqlalchemy.insert(rounds).values(
+                prompt_id=prompt_id,
+                community_id=cid,
+                creation_time=now.shift(days=days),
+                start_time=now.shift(days=days),
+                completion_time=now.shift(days=days, hours=12),
+                end_time=now.shift(days=days + 2, hours=12),
+            )
+            round_ids.append(conn.execute(stmt).inserted_primary_key[0])
+        conn.commit()
+
+        def cleanup():
+            conn.rollback()
+            conn.execute(sqlalchemy.delete(rounds).where(rounds.c.id.in_(round_ids)))
+            stmt = sqlalchemy.delete(db.models.prompts).where(
+                db.models.prompts.c.id == prompt_id
+            )
+            conn.execute(stmt)
+            conn.commit()
+
+        self.addCleanup(cleanup)
+
+        refreshed = refresh_round_statuses(context, [cid])
+        self.assertEqual(sorted(round_ids), sorted(r["id"] for r in refreshed))
+        self.assertEqual([], refresh_round_statuses(context, [cid]))
+
+        def ids(how_many, status):
+            return [r.id for r in Rounds(context, how_many, status, None, cid).all()]
+
+        self.assertEqual([round_ids[0]], ids(None, "archived"))
+        self.assertEqual([round_ids[2]], ids(1, "completed"))
+        self.assertEqual(round_ids[:0:-1], ids(None, "completed"))
+        self.assertEqual(round_ids[::-1], ids(None, None))
+
+        # rounds are filtered on their current status, even when the stored
+        # one hasn't been refreshed yet.
+        stmt = (
+            sqlalchemy.update(rounds)
+            .where(rounds.c.id == round_ids[2])
+            .values(status="accept_answers")
+        )
+        conn.execute(stmt)
+        self.assertEqual(round_ids[:0:-1], ids(None, "completed"))
+        self.assertEqual([], ids(None, "accept_answers"))
+        refreshed = refresh_round_statuses(context, [cid])
+        self.assertEqual(round_ids[2:], [r["id"] for r in refreshed])
+
+        # the prompts of listed rounds find their round without a query.
+        ctx = get_context()
+        listed = Rounds(ctx, None, None, None, cid).all()
+        listed[0].prompt
+        statements = []
+        sqlalchemy.event.listen(
+            ctx["db-conn"],
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2]),
+        )
+        self.assertIs(listed[0], listed[0].prompt.round)
+        self.assertEqual(0, listed[0].prompt.num_replies)
+        self.assertEqual([], statements)
+
+        # reading a status doesn't send the closed notification.
+        self.assertEqual("completed", Rounds.get(context, round_ids[2]).status)
+        stmt = sqlalchemy.select(rounds.c.completion_notif_sent).where(
+            rounds.c.id == round_ids[2]
+        )
+        self.assertIsNone(conn.execute(stmt).scalar())
+
+        Rounds.get(context, round_ids[2]).archive_now()
+        self.assertEqual([round_ids[1]], ids(None, "completed"))
+        # archived rounds are read from the stored status, which archive_now
+        # refreshes.
+        self.assertEqual(round_ids[2::-2], ids(None, "archived"))
+        self.assertEqual("archived", Rounds.get(context, round_ids[2]).status)
+
+        # only one of concurrent senders claims a notification.
+        claims = []
+        for ctx in [get_context(), get_context()]:
+            round = Rounds.get(ctx, round_ids[1])
+            claims.append(round.mark_notification_as_sent("completion_notif_sent"))
+            ctx["db-conn"].commit()
+        self.assertEqual([True, False], claims)
+
+    def test_notification_outbox(self):
+        """
+        Testing notifications are coalesced in the outbox, then sent in
+        batches and retried when they fail.
+        """
+        context = get_context()
+        conn = context["db-conn"]
+        cid = test_values["communities"][2]["id"]
+        post_id = test_values["posts"][1]["id"]
+        community = Communities.get(context, id=cid)
+        outbox_table = db.models.notification_outbox
+
+        stmt = sqlalchemy.insert(db.models.prompts).values(
+            post_id=post_id, priority=1, status="used"
+        )
+        prompt_id = conn.execute(stmt).inserted_primary_key[0]
+        now = api_time.utcnow()
+        stmt = sqlalchemy.insert(db.models.rounds).values(
+            prompt_id=prompt_id,
+            community_id=cid,
+            creation_time=now,
+            start_time=now,
+            completion_time=now.shift(days=1),
+            end_time=now.shift(days=2),
+        )
+        round_id = conn.execute(stmt).inserted_primary_key[0]
+        conn.commit()
+
+        def cleanup():
+            conn.rollback()
+            # outbox rows of the round are deleted with it.
+            conn.execute(sqlalchemy.delete(outbox_table).where(ours))
+            conn.execute(
+                sqlalchemy.delete(db.models.rounds).where(
+                    db.models.rounds.c.id == round_id
+                )
+            )
+            conn.execute(
+                sqlalchemy.delete(db.models.prompts).where(
+                    db.models.prompts.c.id == prompt_id
+                )
+            )
+            conn.commit()
+
+        self.addCleanup(cleanup)
+
+        with mock.patch.object(notifications, "ALLOW_NOTIFICATIONS", True):
+            round = Rounds.get(context, round_id)
+            self.assertTrue(notifications.send_new_round_notification(round, community))
+            self.assertFalse(
+                notifications.send_new_round_notification(round, community)
+            )
+        topic = "outbox-test-topic"
+        for kind in ["subscribe", "unsubscribe", "subscribe"]:
+            outbox.enqueue(context, kind, topic, token="outbox-test-1")
+        outbox.enqueue(context, "unsubscribe", topic, token="outbox-test-2")
+        conn.commit()
+
+        ours = (outbox_table.c.round_id == round_id) | outbox_table.c.token.startswith(
+            "outbox-test-"
+        )
+        stmt = sqlalchemy.select(outbox_table.c.kind).where(
+            ours, outbox_table.c.sent_time.is_(None)
+        )
+        self.assertEqual(
+            ["new_round", "subscribe", "unsubscribe"],
+            sorted(conn.execute(stmt).scalars()),
+        )
+
+        fcm = FakeFCM(failure_rate=1)
+        self.assertEqual({"sent": 0, "failed": 3}, outbox.dispatch(context, fcm))
+        # failed rows wait for their retry.
+        self.assertEqual({"sent": 0, "failed": 0}, outbox.dispatch(context, fcm))
+
+        stmt = sqlalchemy.update(outbox_table).where(ours)
+        conn.execute(stmt.values(next_attempt_time=now))
+        conn.commit()
+        fcm = FakeFCM()
+        self.assertEqual({"sent": 3, "failed": 0}, outbox.dispatch(context, fcm))
+        self.assertEqual(1, len(fcm.sent))
+        self.assertEqual(f'"{round.prompt.post.text}"', fcm.sent[0].notification.body)
+        self.assertEqual({"outbox-test-1"}, fcm.topics[topic])
+
+        # sent rows and rows given up on are deleted after RETENTION.
+        outbox.enqueue(context, "unsubscribe", topic, token="outbox-test-3")
+        pending = stmt.where(outbox_table.c.sent_time.is_(None))
+        conn.execute(pending.values(attempts=outbox.MAX_ATTEMPTS))
+        conn.commit()
+        self.assertEqual({"sent": 0, "failed": 0}, outbox.dispatch(context, fcm))
+
+        stmt = sqlalchemy.select(sqlalchemy.func.count()).where(ours)
+        outbox.prune(context, api_time.utcnow())
+        self.assertEqual(4, conn.execute(stmt).scalar())
+        later = api_time.utcnow().shift(seconds=outbox.RETENTION + 1)
+        outbox.prune(context, later)
+        self.assertEqual(0, conn.execute(stmt).scalar())
+
+    def test_fcm_topic_subscriptions(self, persona_idx=13):
+        """
+        Testing a revoked token is only unsubscribed from the topics it was
+        subscribed to.
+        """
+        context = get_context()
+        conn = context["db-conn"]
+        pid = test_values["personas"][persona_idx]["id"]
+        persona = Personas.get(context, persona_id=pid)
+        communities = [
+            Communities.get(context, id=test_values["communities"][i]["id"])
+            for i in [0, 1]
+        ]
+        token = "subscriptions-test-token"
+        subscriptions = db.models.fcm_topic_subscriptions
+        outbox_table = db.models.notification_outbox
+        tokens = db.models.fcm_tokens
+
+        conn.execute(
+            sqlalchemy.insert(tokens).values(
+                token=token, persona_id=pid, creation_time=api_time.utcnow()
+            )
+        )
+        conn.commit()
+
+        def cleanup():
+            conn.rollback()
+            conn.execute(
+                sqlalchemy.delete(outbox_table).where(outbox_table.c.token == token)
+            )
+            conn.execute(
+                sqlalchemy.delete(subscriptions).where(subscriptions.c.token == token)
+            )
+            conn.execute(sqlalchemy.delete(tokens).where(tokens.c.token == token))
+            conn.commit()
+
+        self.addCleanup(cleanup)
+
+        def topics(table):
+            stmt = sqlalchemy.select(table.c.topic).where(table.c.token == token)
+            return sorted(conn.execute(stmt).scalars())
+
+        for community in communities:
+            persona.join_community(community)
+        persona.leave_community(communities[0])
+        conn.commit()
+        topic = notification_handlers.notif_topic_prefix + (
+            communities[1].notif_all_members_topic
+        )
+        self.assertEqual([topic], topics(subscriptions))
+
+        self.assertTrue(notification_handlers.handle_revoke_token(context, token))
+        persona.leave_community(communities[1])
+        conn.commit()
+        self.assertEqual([], topics(subscriptions))
+        stmt = sqlalchemy.select(outbox_table.c.kind).where(
+            outbox_table.c.token == token, outbox_table.c.sent_time.is_(None)
+        )
+        self.assertEqual(["unsubscribe"] * 2, list(conn.execute(stmt).scalars()))
+
+    def test_reply_counts(self):
+        """
+        Testing the reply counts of prompts follow their replies, and are
+        rebuilt by refresh_reply_counts.
+        """
+        context = get_context()
+        conn = context["db-conn"]
+        cid = test_values["communities"][1]["id"]
+        pid = test_values["personas"][1]["id"]
+        post_id = test_values["posts"][1]["id"]
+        prompts = db.models.prompts
+        audios = db.models.audios
+        posts = db.models.posts
+        disputes = db.models.mod_disputes
+
+        stmt = sqlalchemy.insert(prompts).values(
+            post_id=post_id, priority=1, status="used"
+        )
+        prompt_id = conn.execute(stmt).inserted_primary_key[0]
+        audio_ids = []
+        for _ in range(2):
+            stmt = sqlalchemy.insert(audios).values(creation_time=api_time.utcnow())
+            audio_ids.append(conn.execute(stmt).inserted_primary_key[0])
+        conn.commit()
+        reply_ids = []
+
+        def cleanup():
+            conn.rollback()
+            conn.execute(
+                sqlalchemy.delete(disputes).where(disputes.c.post_id.in_(reply_ids))
+            )
+            conn.execute(sqlalchemy.delete(posts).where(posts.c.id.in_(reply_ids)))
+            conn.execute(sqlalchemy.delete(audios).where(audios.c.id.in_(audio_ids)))
+            conn.execute(sqlalchemy.delete(prompts).where(prompts.c.id == prompt_id))
+            conn.commit()
+
+        self.addCleanup(cleanup)
+
+        def counts():
+            stmt = sqlalchemy.select(
+                prompts.c.reply_count, prompts.c.visible_reply_count
+            ).where(prompts.c.id == prompt_id)
+            return tuple(conn.execute(stmt).one())
+
+        with mock.patch.object(posts_resolvers, "PROCESS_NEW_POST_IN_SERIES", False):
+            for audio_id in audio_ids:
+                reply = posts_resolvers.create_post(
+                    context,
+                    audio_id=audio_id,
+                    text="reply",
+                    community_id=cid,
+                    author_id=pid,
+                    in_reply_to=post_id,
+                )
+                reply_ids.append(reply.id)
+        # replies only count once their mp3 is available.
+        self.assertEqual((0, 0), counts())
+        for audio_id in audio_ids:
+            Audios.update(context, audio_id, {"available_mp3": True})
+        self.assertEqual((2, 2), counts())
+
+        stmt = sqlalchemy.insert(disputes).values(
+            status="pending",
+            post_id=reply_ids[0],
+            disputer_id=pid,
+            metadata="{}",
+            creation_time=api_time.now(),
+        )
+        conn.execute(stmt)
+        self.assertEqual([prompt_id], refresh_reply_counts(context, [post_id]))
+        self.assertEqual((2, 1), counts())
+
+        conn.execute(
+            sqlalchemy.update(prompts)
+            .where(prompts.c.id == prompt_id)
+            .values(reply_count=10, visible_reply_count=10)
+        )
+        self.assertIn(prompt_id, refresh_reply_counts(context))
+        self.assertEqual((2, 1), counts())
+        self.assertEqual([], refresh_reply_counts(context, [post_id]))
+        conn.commit()
+
+        # replies are paged by id, pages don't shift when earlier ones go.
+        def page(first, after=None):
+            replies = Prompts.get(context, prompt_id).replies(None, first, after)
+            return [node.id for node in replies.nodes], replies.pageInfo
+
+        ids, page_info = page(1)
+        self.assertEqual(reply_ids[:1], ids)
+        self.assertEqual(
+            {"endCursor": str(reply_ids[0]), "hasNextPage": True}, page_info
+        )
+        conn.execute(
+            sqlalchemy.update(posts)
+            .where(posts.c.id == reply_ids[0])
+            .values(mod_removed=True)
+        )
+        ids, page_info = page(1, int(page_info["endCursor"]))
+        self.assertEqual(reply_ids[1:], ids)
+        self.assertFalse(page_info["hasNextPage"])
+        self.assertEqual(reply_ids[1:], page(2)[0])
+        conn.commit()
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=1)
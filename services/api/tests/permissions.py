@@ -8,6 +8,8 @@ import sys
 sys.path.append("./")
 import unittest
 
+import db.models
+import sqlalchemy
 from api.resolvers import Communities, Personas
 from api.resolvers.permissions import Permissions
 from api.tests import TestBase, get_context, test_values
@@ -611,6 +613,158 @@ class TestPermissionsMethods(TestBase):
         context["db-conn"].commit()
         self.assertEqual(m_status, "unregistered")
 
+    def test_permission_masks(self):
+        perms = ["unittest_mask_a", "unittest_mask_b"]
+        for perm in perms:
+            Permissions.add_permission(perm)
+        Permissions.set_group("__unittest_mask__", perms)
+        Permissions.set_role("unittest_mask_role", ["__unittest_mask__"])
+
+        masks = Permissions.masks()
+        role_mask = masks.roles_mask(["unittest_mask_role"])
+        self.assertEqual(masks.mask_of(perms), role_mask)
+        self.assertEqual(perms, masks.perms_of(role_mask))
+        self.assertTrue(masks.has(role_mask, perms[0]))
+        self.assertFalse(masks.has(role_mask, "persona.view_pkh"))
+
+        # permissions appended directly are compiled on next use.
+        Permissions.metadata["permissions"].append("unittest_mask_c")
+        self.assertTrue("unittest_mask_c" in Permissions.masks().bits)
+
+    def test_membership_permissions_cache(self, persona_idx=20):
+        """
+        Tests roles and permissions are cached across requests, and
+        refreshed by changes made through communities and personas.
+        """
+        pid = test_values["personas"][persona_idx]["id"]
+        cid = test_values["communities"][0]["id"]
+
+        context = get_context()
+        persona = Personas.get(context, persona_id=pid)
+        community = Communities.get(context, id=cid)
+        self.assertEqual(["persona"], persona.role_in_community(community))
+        self.assertEqual(persona.join_community(community), "registered")
+        context["db-conn"].commit()
+
+        other = get_context()
+        other_persona = Personas.get(other, persona_id=pid)
+        other_community = Communities.get(other, id=cid)
+        roles = other_persona.role_in_community(other_community)
+        self.assertEqual(["persona", "member"], roles)
+
+        community.handle_role(persona, "moderator", "add")
+        roles = Personas.get(get_context(), persona_id=pid).role_in_community(community)
+        self.assertEqual(sorted(["persona", "member", "moderator"]), sorted(roles))
+
+        # changes made directly in the db are seen once invalidated.
+        conn = context["db-conn"]
+        mid = persona.membership_permissions(community)["membership_id"]
+        conn.execute(
+            sqlalchemy.delete(db.models.community_roles).where(
+                db.models.community_roles.c.membership_id == mid
+            )
+        )
+        conn.commit()
+        roles = Personas.get(get_context(), persona_id=pid).role_in_community(community)
+        self.assertTrue("moderator" in roles)
+        persona.invalidate_memberships()
+        conn.commit()
+        roles = Personas.get(get_context(), persona_id=pid).role_in_community(community)
+        self.assertEqual(["persona", "member"], roles)
+
+        self.assertEqual(persona.leave_community(community), "unregistered")
+        context["db-conn"].commit()
+        other_persona = Personas.get(get_context(), persona_id=pid)
+        self.assertFalse(other_persona.is_in_community(community))
+
+    def test_bulk_registration(self):
+        """
+        Tests registering several personas, and their roles and permissions,
+        at once responds and changes as one at a time does.
+        """
+        context = get_context()
+        perms = ["unittest_bulk_perm_a", "unittest_bulk_perm_b"]
+        unrelated_perm = "unittest_bulk_perm_u"
+        group, role = "__unittest_bulk_group__", "facilitator"
+        for perm in perms + [unrelated_perm]:
+            Permissions.add_permission(perm)
+        Permissions.set_group(group, perms)
+        Permissions.set_role(role, [group])
+
+        cid = test_values["communities"][0]["id"]
+        community = Communities.get(context, id=cid)
+        personas = [
+            Personas.get(context, persona_id=test_values["personas"][i]["id"])
+            for i in range(36, 40)
+        ]
+        p0, p1, p2, p3 = personas
+        self.assertEqual(p0.join_community(community), "registered")
+        context["db-conn"].commit()
+
+        def cleanup():
+            context["db-conn"].rollback()
+            community.handle_registrations(personas, "unregister")
+            context["db-conn"].commit()
+
+        self.addCleanup(cleanup)
+
+        responses = community.handle_registrations([p0, p1, p2, p1], "register")
+        self.assertEqual(
+            ["already registered", "registered", "registered", "already registered"],
+            responses,
+        )
+        context["db-conn"].commit()
+        self.assertTrue(all(p.is_in_community(community) for p in [p0, p1, p2]))
+
+        # the grant patch made redundant by the role is dropped.
+        self.assertEqual("granted", community.handle_permission(p1, perms[0], "grant"))
+        responses = community.handle_roles([p0, p1, p3], role, "add")
+        self.assertEqual(["Added", "Added", "Not part of community"], responses)
+        self.assertEqual([], p1.user_perm_patches(community)["grant"])
+        self.assertTrue(role in p1.role_in_community(community))
+        responses = community.handle_roles([p0], role, "add")
+        self.assertEqual([f"Already has role {role}."], responses)
+
+        responses = community.handle_permissions([p0, p1, p2, p0], perms[0], "revoke")
+        self.assertEqual(
+            [
+                "revoked",
+                "revoked",
+                f"Already not allowed to {perms[0]}.",
+                f"Already not allowed to {perms[0]}.",
+            ],
+            responses,
+        )
+        for persona in [p0, p1, p2]:
+            permissions = persona.user_permissions(community)["permissions"]
+            self.assertFalse(perms[0] in permissions)
+
+        # the same changes one at a time now have nothing left to do.
+        for persona in [p0, p1, p2]:
+            response = community.handle_permission(persona, perms[0], "revoke")
+            self.assertEqual(f"Already not allowed to {perms[0]}.", response)
+        responses = community.handle_permissions([p1, p2, p2], perms[0], "grant")
+        self.assertEqual(
+            ["granted.", "granted", f"Already had perm to {perms[0]}."], responses
+        )
+        self.assertEqual([], p1.user_perm_patches(community)["grant"])
+        self.assertEqual([perms[0]], p2.user_perm_patches(community)["grant"])
+        for persona in [p1, p2]:
+            response = community.handle_permission(persona, perms[0], "grant")
+            self.assertEqual(f"Already had perm to {perms[0]}.", response)
+
+        responses = community.handle_roles([p0, p2], role, "remove")
+        self.assertEqual(["Removed", f"Didn't have role {role}."], responses)
+        context["db-conn"].commit()
+
+        responses = community.handle_registrations(personas, "unregister")
+        self.assertEqual(
+            ["unregistered", "unregistered", "unregistered", "already unregistered"],
+            responses,
+        )
+        context["db-conn"].commit()
+        self.assertFalse(any(p.is_in_community(community) for p in personas))
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=1)
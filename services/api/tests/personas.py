@@ -0,0 +1,120 @@
+"""
+from services/
+python3 -m unittest api/tests/personas.py
+"""
+
+import sys
+
+sys.path.append("./")
+import time
+import unittest
+from unittest import mock
+
+import db.models
+import graphql
+import sqlalchemy
+from api import planner
+from api.resolvers import Audios, Personas, SIWFAccounts
+from api.tests import TestBase, get_context, test_values
+from api.time import time as api_time
+
+
+class TestPersonaMethods(TestBase):
+    def test_msa_handle(self, persona_idxs=(20, 21, 22)):
+        """
+        Testing msa_handle is only fetched when requested, once for all
+        personas of a context, and stored in frequency_metadata.
+        """
+        context = get_context()
+        pids = [test_values["personas"][idx]["id"] for idx in persona_idxs]
+        msa_ids = [f"unittest_msa_{idx}" for idx in persona_idxs]
+        for pid, msa_id in zip(pids[:2], msa_ids):
+            stmt = sqlalchemy.insert(db.models.frequency_metadata).values(
+                msa_id=msa_id, persona_id=pid, creation_time=api_time.utcnow()
+            )
+            context["db-conn"].execute(stmt)
+        context["db-conn"].commit()
+
+        fetch = mock.patch.object(
+            SIWFAccounts, "fetch_msa_handle", side_effect=lambda m: f"handle_{m}"
+        )
+        with fetch as fetch_msa_handle:
+            personas = [Personas.get(context, persona_id=pid) for pid in pids]
+            fetch_msa_handle.assert_not_called()
+
+            self.assertEqual(personas[0].msa_handle, "handle_unittest_msa_20")
+            self.assertEqual(fetch_msa_handle.call_count, 2)
+            self.assertEqual(personas[1].msa_handle, "handle_unittest_msa_21")
+            self.assertIsNone(personas[2].msa_handle)
+            self.assertEqual(fetch_msa_handle.call_count, 2)
+
+        # handles are stored in the background.
+        stmt = sqlalchemy.select(db.models.frequency_metadata.c.msa_handle).where(
+            db.models.frequency_metadata.c.persona_id.in_(pids)
+        )
+        for _ in range(50):
+            stored = context["db-conn"].execute(stmt).scalars().all()
+            context["db-conn"].commit()
+            if all(stored):
+                break
+            time.sleep(0.1)
+        self.assertEqual(
+            sorted(stored), ["handle_unittest_msa_20", "handle_unittest_msa_21"]
+        )
+
+    def test_query_planner(self):
+        """
+        Testing the relationships selected by a query are loaded with one
+        query, fragments included.
+        """
+        context = get_context()
+        document = graphql.parse(
+            """
+            query {
+              promptReplies(prompt_id: 1) {
+                edges { node { id ...reply audio { id plain_transcript } } }
+              }
+            }
+            fragment reply on Post { author { name msa_handle image { id } } }
+            """
+        )
+        field = document.definitions[0].selection_set.selections[0]
+        fragments = {document.definitions[1].name.value: document.definitions[1]}
+        info = mock.Mock(field_nodes=[field], fragments=fragments)
+        tree = planner.selections(info, "edges", "node")
+        self.assertEqual(
+            {
+                "id": {},
+                "author": {"name": {}, "msa_handle": {}, "image": {"id": {}}},
+                "audio": {"id": {}, "plain_transcript": {}},
+            },
+            tree,
+        )
+
+        posts = test_values["posts"][:3]
+        vtt = [{"start": 0, "end": 1, "text": "hello "}, {"text": "world"}]
+        Audios.update_transcripts(context, posts[0]["audio_id"], vtt)
+        context["db-conn"].commit()
+        statements = []
+        sqlalchemy.event.listen(
+            context["db-conn"],
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2]),
+        )
+        planner.prime(context, "Post", [post["id"] for post in posts], tree)
+        self.assertEqual(1, len(statements))
+
+        for post in posts:
+            author = Personas.get(context, persona_id=post["author_id"])
+            self.assertIsNone(author.msa_handle)
+            audio = Audios.get(context, post["audio_id"])
+            self.assertEqual(post["audio_id"], audio.id)
+            audio.plain_transcript
+        self.assertEqual(1, len(statements))
+        audio = Audios.get(context, posts[0]["audio_id"])
+        self.assertEqual("hello  world", audio.plain_transcript)
+        self.assertEqual(vtt, audio.transcripts)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
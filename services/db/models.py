@@ -36,7 +36,10 @@ frequency_metadata = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("msa_id", String, nullable=False, unique=True),
     Column("persona_id", Integer, ForeignKey("personas.id"), nullable=False, unique=True),
-    Column("creation_time", ArrowType, nullable=False)
+    Column("creation_time", ArrowType, nullable=False),
+    # last handle fetched from the accounts gateway, and when.
+    Column("msa_handle", String, nullable=True),
+    Column("msa_handle_time", ArrowType, nullable=True),
 )
 
 fcm_tokens = Table(
@@ -50,6 +53,16 @@ fcm_tokens = Table(
 Index("pair_index", fcm_tokens.c.token, fcm_tokens.c.persona_id, unique=True)
 Index("token_index", fcm_tokens.c.token, unique=True)
 
+# FCM topics each token is subscribed to, so revoking a token only
+# unsubscribes it from those.
+fcm_topic_subscriptions = Table(
+    "fcm_topic_subscriptions",
+    metadata,
+    Column("token", String, primary_key=True),
+    Column("topic", String, primary_key=True),
+    Column("creation_time", ArrowType, nullable=False),
+)
+
 communities = Table(
     "communities",
     metadata,
@@ -98,6 +111,8 @@ posts = Table(
     Column("mod_removed", Boolean, nullable=False, default=False),
     Column("mod_metadata", String, nullable=True, default=""),
 )
+# replies of a post in id order, see Prompt.get_replies.
+Index("reply_index", posts.c.in_reply_to, posts.c.id)
 
 audios = Table(
     "audios",
@@ -111,6 +126,27 @@ audios = Table(
     ),
 )
 
+# transcripts and waveforms of audios, kept out of audios.info as they are
+# much larger and only read when requested.
+audio_transcripts = Table(
+    "audio_transcripts",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column(
+        "audio_id",
+        Integer,
+        ForeignKey("audios.id", ondelete="CASCADE"),
+        nullable=False,
+        unique=True,
+    ),
+    # JSON list of {"start", "end", "text"}.
+    Column("vtt", String, nullable=True),
+    Column("plain_transcript", String, nullable=True),
+    # JSON list of floats.
+    Column("wave_values", String, nullable=True),
+    Column("creation_time", ArrowType, nullable=False),
+)
+
 images = Table(
     "images",
     metadata,
@@ -129,8 +165,13 @@ prompts = Table(
         "status", Enum("eligible", "used", "removed", native_enum=False), nullable=False
     ),
     # CheckConstraint("status IN ('eligible', 'used', 'removed')", name='status_in'),
+    # replies not removed whose mp3 is available, and those of them without
+    # open disputes, see refresh_reply_counts.
+    Column("reply_count", Integer, nullable=False, server_default="0"),
+    Column("visible_reply_count", Integer, nullable=False, server_default="0"),
 )
 
+round_statuses = ("eligible", "accept_answers", "completed", "archived", "erroneous")
 rounds = Table(
     "rounds",
     metadata,
@@ -148,6 +189,15 @@ rounds = Table(
     # CheckConstraint("start_time >= creation_time", name='st>=ct'),
     Column("start_notif_sent", Boolean, nullable=True),
     Column("completion_notif_sent", Boolean, nullable=True),
+    # Round.status as of status_time, kept up to date by the round workers.
+    Column("status", Enum(*round_statuses, native_enum=False), nullable=True),
+    Column("status_time", ArrowType, nullable=True),
+)
+Index(
+    "round_status_index",
+    rounds.c.community_id,
+    rounds.c.status,
+    rounds.c.id.desc(),
 )
 
 available_roles = ("owner", "moderator", "trustee", "facilitator")
@@ -250,3 +300,40 @@ Index(
     community_bridges.c.community_b_id,
     unique=True,
 )
+
+
+# notifications to send to FCM, written by the mutations causing them and
+# sent by api.outbox.dispatch.
+notification_kinds = ("new_round", "round_closed", "subscribe", "unsubscribe")
+notification_outbox = Table(
+    "notification_outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("kind", Enum(*notification_kinds, native_enum=False), nullable=False),
+    # pending events with the same key are coalesced into one.
+    Column("dedupe_key", String, nullable=False),
+    Column("topic", String, nullable=False),
+    Column(
+        "round_id",
+        Integer,
+        ForeignKey("rounds.id", ondelete="CASCADE"),
+        nullable=True,
+    ),
+    Column("token", String, nullable=True),
+    Column("creation_time", ArrowType, nullable=False),
+    Column("attempts", Integer, nullable=False, server_default="0"),
+    Column("next_attempt_time", ArrowType, nullable=False),
+    Column("sent_time", ArrowType, nullable=True),
+    Column("error", String, nullable=True),
+)
+Index(
+    "outbox_pending_key_index",
+    notification_outbox.c.dedupe_key,
+    unique=True,
+    postgresql_where=notification_outbox.c.sent_time.is_(None),
+)
+Index(
+    "outbox_pending_index",
+    notification_outbox.c.next_attempt_time,
+    postgresql_where=notification_outbox.c.sent_time.is_(None),
+)
@@ -6,6 +6,14 @@ import api
 import api.resolvers as resolvers
 import boto3
 import sqlalchemy
+from api import outbox
+from api.resolvers.rounds import refresh_round_statuses
+
+from jobs.round_scheduler import (
+    WORKER_THREADS,
+    process_communities,
+    process_communities_concurrently,
+)
 
 # You can put initialization code here. See
 # https://docs.aws.amazon.com/lambda/latest/dg/lambda-runtime-environment.html
@@ -30,6 +38,10 @@ CONNECTION_STRING = os.getenv("DB_CONNECTION_STRING")
 engine = sqlalchemy.create_engine(f"postgresql+psycopg2://{CONNECTION_STRING}")
 logger.info("Connecting to sqlalchemy engine")
 
+# "pending" only loads the communities that need a round transition,
+# "all" checks every community.
+SCHEDULER_MODE = os.getenv("ROUND_SCHEDULER_MODE", "pending")
+
 
 def handler(event, context):
     # This is executed once a minute.
@@ -37,15 +49,23 @@ def handler(event, context):
         context = {"db-conn": conn}
         logger.info(f"worker event: {event}")
 
-        communities = resolvers.Communities(context).all()
-        for community in communities:
-            # following line triggers a notification the first time it's true
-            if not community.is_active or community.active_round.completed:
-                # If force=False, and round isn't completed it won't be archived.
-                # If force=True, will forcefully archive current round.
-                community.move_to_next_round(force=False, printfn=logger.info)
-            else:
-                logger.info(f"Community.id {community.id} is_active.")
+        refresh_round_statuses(context)
+        context["db-conn"].commit()
+
+        if SCHEDULER_MODE == "all":
+            communities = resolvers.Communities(context).all()
+        else:
+            communities = resolvers.Communities.needing_round_transition(context)
+        logger.info(f"{len(communities)} communities to process")
+        if WORKER_THREADS > 1:
+            community_ids = [community.id for community in communities]
+            process_communities_concurrently(engine, community_ids)
+        else:
+            process_communities(context, communities)
+        context["db-conn"].commit()
+
+        # round notifications, and retries of earlier ones.
+        outbox.dispatch_all(engine)
 
         context["db-conn"].commit()
         context["db-conn"].close()
@@ -0,0 +1,226 @@
+"""
+Moves communities to their next round when it is due, instead of checking
+every community once a minute.
+
+RoundScheduler keeps a heap with the next instant each community needs the
+round worker: its active round's completion_time or end_time, an upcoming
+round's start_time, or now if it has no active round but eligible prompts.
+At each deadline, it also stores the new status of rounds (rounds.status).
+The heap is rebuilt from the db at start, and a community's deadline is
+reloaded whenever its rounds change through Rounds.create, Round.close_now
+or Round.archive_now, which invalidate "round_deadlines" (see api.cache).
+
+from services/
+python3 -m jobs.round_scheduler
+"""
+
+import heapq
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import api.resolvers as resolvers
+import db.models
+import sqlalchemy
+from dotenv import load_dotenv
+
+from api import cache, outbox
+from api.notifications import send_round_has_closed_notification
+from api.resolvers.communities import round_transition_lock
+from api.resolvers.rounds import refresh_round_statuses
+from api.time import time
+
+logger = logging.getLogger("worker")
+
+# a community whose transition failed (e.g. it has no prompt left to pick)
+# is retried after RETRY_DELAY seconds, as the minute worker did.
+RETRY_DELAY = 60
+# deadlines are reloaded from the db at least this often, bounding how late
+# a change made outside the API can be noticed.
+MAX_SLEEP = int(os.getenv("ROUND_SCHEDULER_MAX_SLEEP", 15 * 60))
+# communities processed at the same time, each on its own connection.
+WORKER_THREADS = int(os.getenv("ROUND_WORKER_THREADS", 4))
+
+
+def process_communities(context, communities):
+    for community in communities:
+        active_round = community.active_round
+        if active_round is not None and active_round.completed:
+            # only sent the first time, see completion_notif_sent.
+            send_round_has_closed_notification(active_round, community)
+        if active_round is None or active_round.completed:
+            # If force=False, and round isn't completed it won't be archived.
+            # If force=True, will forcefully archive current round.
+            community.move_to_next_round(force=False, printfn=logger.info)
+        else:
+            logger.info(f"Community.id {community.id} is_active.")
+
+
+def process_community(engine, community_id):
+    """Processes community_id on a connection of its own, unless another
+    worker is already moving it to its next round."""
+    try:
+        with engine.connect() as conn:
+            context = {"db-conn": conn}
+            with round_transition_lock(context, community_id, wait=False) as locked:
+                if not locked:
+                    logger.info(f"Community.id {community_id} is being processed")
+                    return
+                # checked again, now that no one else can change its rounds.
+                communities = resolvers.Communities.needing_round_transition(
+                    context, [community_id]
+                )
+                process_communities(context, communities)
+            conn.commit()
+    except Exception:
+        logger.exception(f"Community.id {community_id} failed to process")
+
+
+def process_communities_concurrently(engine, community_ids):
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as executor:
+        for community_id in community_ids:
+            executor.submit(process_community, engine, community_id)
+
+
+def next_round_deadlines(context, community_ids=None):
+    """
+    Returns {community_id: deadline}, the next instant each community needs
+    the round worker. Communities with nothing scheduled are left out.
+    """
+    now = time.utcnow()
+    rounds = db.models.rounds
+
+    def upcoming(column, *conditions):
+        return sqlalchemy.case((sqlalchemy.and_(column > now, *conditions), column))
+
+    # least() ignores nulls, so past instants don't count.
+    deadline = sqlalchemy.func.min(
+        sqlalchemy.func.least(
+            upcoming(rounds.c.start_time),
+            upcoming(rounds.c.completion_time),
+            rounds.c.end_time,
+        ),
+        type_=rounds.c.end_time.type,
+    )
+    stmt = (
+        sqlalchemy.select(rounds.c.community_id, deadline)
+        .where(rounds.c.end_time > now)
+        .group_by(rounds.c.community_id)
+    )
+    if community_ids is not None:
+        stmt = stmt.where(rounds.c.community_id.in_(community_ids))
+    deadlines = dict(context["db-conn"].execute(stmt).all())
+
+    due = resolvers.Communities.needing_round_transition(context, community_ids)
+    for community in due:
+        deadlines[community.id] = now
+    return deadlines
+
+
+class RoundScheduler:
+    def __init__(self, engine):
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._heap = []
+        # community_id -> its deadline in _heap, older entries are skipped.
+        self._deadlines = {}
+        self._stale = set()
+        self._rebuild = True
+
+    # api.cache calls pop and clear, as it does for caches.
+    def pop(self, community_id, default=None):
+        with self._lock:
+            self._stale.add(community_id)
+        self._wakeup.set()
+        return default
+
+    def clear(self):
+        with self._lock:
+            self._rebuild = True
+        self._wakeup.set()
+
+    def schedule(self, community_id, deadline):
+        self._deadlines[community_id] = deadline
+        heapq.heappush(self._heap, (deadline, community_id))
+
+    def next_deadline(self):
+        while self._heap:
+            deadline, community_id = self._heap[0]
+            if self._deadlines.get(community_id) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        due = []
+        while self.next_deadline() is not None and self.next_deadline() <= now:
+            _, community_id = heapq.heappop(self._heap)
+            del self._deadlines[community_id]
+            due.append(community_id)
+        return due
+
+    def reload(self, context):
+        with self._lock:
+            rebuild, stale = self._rebuild, self._stale
+            self._rebuild, self._stale = False, set()
+        if rebuild:
+            self._heap, self._deadlines = [], {}
+            deadlines = next_round_deadlines(context)
+        elif stale:
+            for community_id in stale:
+                self._deadlines.pop(community_id, None)
+            deadlines = next_round_deadlines(context, list(stale))
+        else:
+            return
+        for community_id, deadline in deadlines.items():
+            self.schedule(community_id, deadline)
+
+    def run_once(self):
+        """Processes the communities that are due.
+        Returns the next deadline, or None if nothing is scheduled."""
+        with self._engine.connect() as conn:
+            context = {"db-conn": conn}
+            self.reload(context)
+            due = self.pop_due(time.utcnow())
+            # deadlines are status transitions, see Round.status.
+            refresh_round_statuses(context)
+            conn.commit()
+            if due:
+                logger.info(f"{len(due)} communities to process")
+                process_communities_concurrently(self._engine, due)
+                outbox.dispatch_all(self._engine)
+
+                with self._lock:
+                    self._stale.update(due)
+                self.reload(context)
+                now = time.utcnow()
+                for community_id in due:
+                    deadline = self._deadlines.get(community_id)
+                    if deadline is not None and deadline <= now:
+                        self.schedule(community_id, now.shift(seconds=RETRY_DELAY))
+        return self.next_deadline()
+
+    def run(self):
+        cache.register("round_deadlines", self)
+        cache.listen(self._engine)
+        while True:
+            self._wakeup.clear()
+            deadline = self.run_once()
+            timeout = MAX_SLEEP
+            if deadline is not None:
+                until = (deadline - time.utcnow()).total_seconds()
+                timeout = min(MAX_SLEEP, max(until, 0))
+            logger.info(f"next round deadline {deadline}, sleeping {timeout}s")
+            if not self._wakeup.wait(timeout) and timeout == MAX_SLEEP:
+                with self._lock:
+                    self._rebuild = True
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    CONNECTION_STRING = os.getenv("DB_CONNECTION_STRING")
+    engine = sqlalchemy.create_engine(f"postgresql+psycopg2://{CONNECTION_STRING}")
+    RoundScheduler(engine).run()
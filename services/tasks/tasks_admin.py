@@ -7,6 +7,7 @@ from dotenv import load_dotenv
 
 from api.resolvers.permissions import Permissions
 from api.resolvers import Personas, Communities
+from api.resolvers.prompts import refresh_reply_counts
 
 load_dotenv()
 
@@ -89,6 +90,20 @@ def remove_community_flag(c, cid=None, label="", verbose=False):
     print(response)
 
 
+@task
+def reconcile_reply_counts(c, verbose=False):
+    """
+    Rebuilds the reply counts of every prompt from their replies.
+
+    Example:
+        invoke reconcile-reply-counts -v
+    """
+    if verbose:
+        print("\n>>> $ reconcile-reply-counts")
+    response = handle_reconcile_reply_counts(verbose)
+    print(response)
+
+
 ######################################################################
 #################   Manage roles and permissions     #################
 ######################################################################
@@ -263,3 +278,11 @@ def handle_remove_community_flag(context, cid, label, verbose):
     if verbose:
         print("final flags", community.flags)
     return response
+
+
+@with_db_context
+def handle_reconcile_reply_counts(context, verbose):
+    changed = refresh_reply_counts(context)
+    if verbose:
+        print("prompts changed", changed)
+    return f"{len(changed)} prompts had their reply counts fixed"